@@ -0,0 +1,276 @@
+"""
+Бенчмарк хранилища пользователей (storage.py)
+
+Генерирует синтетических пользователей (по умолчанию 1k, 10k, 100k и 1M)
+и во временном каталоге измеряет задержки (p50/p95/p99/max) и пропускную
+способность load_user, save_user, flush_users, get_subscribed_users,
+migrate_user_data, а также смешанной нагрузки чтение/запись из нескольких
+потоков. Сеть и токены не нужны, рабочие данные бота не затрагиваются.
+
+    python bench_storage.py
+    python bench_storage.py --sizes 1000,10000 --backend sqlite --shards 4
+    python bench_storage.py --output before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from typing import Dict, Any, List, Callable
+
+import storage
+
+CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань",
+          "Нижний Новгород", "Самара", "Омск", "Ростов-на-Дону", "Уфа"]
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+SUBSCRIBED_SHARE = 0.3  # доля пользователей с включенными уведомлениями
+
+
+def generate_users(count: int, legacy: bool = False, seed: int = 0) -> Dict[str, Dict[str, Any]]:
+    """
+    Генерирует синтетических пользователей
+
+    Args:
+        count: Количество пользователей (ID от 1 до count)
+        legacy: Старая структура (location объект и поле subscribed)
+        seed: Зерно генератора, чтобы прогоны были сравнимы
+
+    Returns:
+        dict: {user_id_str: user_data} в JSON-форме user_data.json
+    """
+    rnd = random.Random(seed)
+    users = {}
+    for user_id in range(1, count + 1):
+        city = rnd.choice(CITIES)
+        lat = round(rnd.uniform(41.0, 70.0), 4)
+        lon = round(rnd.uniform(20.0, 180.0), 4)
+        enabled = rnd.random() < SUBSCRIBED_SHARE
+
+        if legacy:
+            users[str(user_id)] = {
+                "location": {"name": city, "lat": lat, "lon": lon},
+                "subscribed": enabled
+            }
+        else:
+            users[str(user_id)] = {
+                "city": city,
+                "lat": lat,
+                "lon": lon,
+                "primary_city": None,
+                "notifications": {
+                    "enabled": enabled,
+                    "interval_h": 2,
+                    "start_hour": rnd.randint(0, 12),
+                    "end_hour": rnd.randint(13, 23)
+                },
+                "last_weather": None
+            }
+    return users
+
+
+def populate(users: Dict[str, Dict[str, Any]], schema_version: int) -> None:
+    """Записывает пользователей прямо в хранилища шардов, минуя таблицу в памяти"""
+    shards = storage.USER_SHARDS
+    parts = [{} for _ in range(shards)]
+    for user_id_str, user_data in users.items():
+        parts[storage._shard_index(user_id_str, shards)][user_id_str] = user_data
+
+    for index, part in enumerate(parts):
+        store = storage._open_store(index, shards)
+        try:
+            store.put_many(part)
+            store.set_schema_version(schema_version)
+        finally:
+            store.close()
+
+
+def summarize(latencies: List[float], total: float) -> Dict[str, float]:
+    """
+    Считает перцентили задержки и пропускную способность
+
+    Args:
+        latencies: Задержки отдельных операций, секунды
+        total: Общее время серии, секунды
+
+    Returns:
+        dict: ops, p50_ms, p95_ms, p99_ms, max_ms, ops_per_s
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(p: float) -> float:
+        return latencies[min(count - 1, int(count * p / 100))] * 1000
+
+    return {
+        "ops": count,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": latencies[-1] * 1000,
+        "ops_per_s": count / total if total > 0 else float("inf")
+    }
+
+
+def measure(op: Callable[[Any], Any], args: List[Any]) -> Dict[str, float]:
+    """Выполняет op для каждого аргумента по очереди и замеряет каждую операцию"""
+    latencies = []
+    started = time.perf_counter()
+    for arg in args:
+        op_started = time.perf_counter()
+        op(arg)
+        latencies.append(time.perf_counter() - op_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def measure_once(op: Callable[[], Any]) -> Dict[str, float]:
+    """Замеряет одну долгую операцию (загрузка, сброс, миграция)"""
+    started = time.perf_counter()
+    op()
+    elapsed = time.perf_counter() - started
+    return summarize([elapsed], elapsed)
+
+
+def measure_mixed(user_ids: List[int], threads: int, read_share: float, seed: int) -> Dict[str, float]:
+    """
+    Смешанная нагрузка: threads потоков одновременно читают (load_user)
+    и изменяют (update_user_location) случайных пользователей
+
+    Args:
+        user_ids: ID пользователей; делятся между потоками поровну
+        threads: Количество потоков
+        read_share: Доля чтений среди операций (0-1)
+    """
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(number: int) -> None:
+        rnd = random.Random(seed + number)
+        own = latencies[number]
+        barrier.wait()
+        for user_id in user_ids[number::threads]:
+            op_started = time.perf_counter()
+            if rnd.random() < read_share:
+                storage.load_user(user_id)
+            else:
+                storage.update_user_location(user_id, city=rnd.choice(CITIES),
+                                             lat=rnd.uniform(41.0, 70.0), lon=rnd.uniform(20.0, 180.0))
+            own.append(time.perf_counter() - op_started)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    total = time.perf_counter() - started
+
+    return summarize([latency for own in latencies for latency in own], total)
+
+
+def _use_directory(directory: str) -> Dict[str, str]:
+    """Направляет файлы storage.py во временный каталог; возвращает прежние пути"""
+    previous = {}
+    for name in ("USER_DATA_FILE", "USER_DB_FILE", "USER_JOURNAL_FILE", "USER_SCHEMA_FILE"):
+        previous[name] = getattr(storage, name)
+        setattr(storage, name, os.path.join(directory, os.path.basename(previous[name])))
+    return previous
+
+
+def bench_size(count: int, ops: int, threads: int, read_share: float, seed: int) -> Dict[str, Dict[str, float]]:
+    """Прогоняет все замеры для одного размера набора пользователей"""
+    results = {}
+    rnd = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix="bench_storage_")
+    previous = _use_directory(directory)
+
+    try:
+        # Набор текущей структуры
+        populate(generate_users(count, seed=seed), storage.SCHEMA_VERSION)
+        storage.reset_store()
+
+        results["загрузка (холодный старт)"] = measure_once(lambda: len(storage.users_snapshot()))
+
+        read_ids = [rnd.randint(1, count) for _ in range(ops)]
+        results["load_user"] = measure(storage.load_user, read_ids)
+
+        def save(user_id: int) -> None:
+            user_data = storage.load_user(user_id).to_dict()
+            user_data["city"] = rnd.choice(CITIES)
+            storage.save_user(user_id, user_data)
+
+        write_ids = [rnd.randint(1, count) for _ in range(ops)]
+        results["save_user"] = measure(save, write_ids)
+        results["flush_users"] = measure_once(storage.flush_users)
+
+        results["get_subscribed_users()"] = measure(lambda _: storage.get_subscribed_users(), range(3))
+        storage.get_subscribed_users(hour=0)  # построение индекса - не в замере
+        results["get_subscribed_users(hour)"] = measure(
+            lambda hour: storage.get_subscribed_users(hour=hour), list(range(24)))
+
+        mixed_ids = [rnd.randint(1, count) for _ in range(ops)]
+        results[f"смешанная ({threads} потоков)"] = measure_mixed(mixed_ids, threads, read_share, seed)
+        storage.flush_users()
+        storage.reset_store()
+
+        # Набор старой структуры для миграции
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        populate(generate_users(count, legacy=True, seed=seed), 1)
+        results["migrate_user_data"] = measure_once(storage.migrate_user_data)
+        storage.reset_store()
+    finally:
+        storage.reset_store()
+        for name, path in previous.items():
+            setattr(storage, name, path)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def print_results(count: int, results: Dict[str, Dict[str, float]]) -> None:
+    """Печатает результаты одного размера таблицей"""
+    print(f"\n👥 Пользователей: {count:,} (бэкенд {storage.STORAGE_BACKEND}, шардов {storage.USER_SHARDS})")
+    print(f"{'операция':<30}{'ops':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}{'ops/s':>12}")
+    for name, row in results.items():
+        print(f"{name:<30}{row['ops']:>8}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}"
+              f"{row['p99_ms']:>10.3f}{row['max_ms']:>10.3f}{row['ops_per_s']:>12.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилища пользователей")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="размеры наборов через запятую")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default=storage.STORAGE_BACKEND)
+    parser.add_argument("--shards", type=int, default=storage.USER_SHARDS)
+    parser.add_argument("--ops", type=int, default=10_000, help="операций в каждой серии")
+    parser.add_argument("--threads", type=int, default=8, help="потоков в смешанной нагрузке")
+    parser.add_argument("--read-share", type=float, default=0.9, help="доля чтений в смешанной нагрузке")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="сохранить результаты в JSON для сравнения до/после")
+    args = parser.parse_args()
+
+    storage.STORAGE_BACKEND = args.backend
+    storage.USER_SHARDS = args.shards
+    storage.USER_MIGRATION_PAUSE = 0  # в бенчмарке обработчиков нет, ждать некого
+
+    report = {"backend": args.backend, "shards": args.shards, "sizes": {}}
+    for count in (int(size) for size in args.sizes.split(",")):
+        results = bench_size(count, args.ops, args.threads, args.read_share, args.seed)
+        print_results(count, results)
+        report["sizes"][str(count)] = results
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
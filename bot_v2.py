@@ -13,9 +13,17 @@ from weather_cached import (
     get_coordinates,
     get_hourly_weather,
     get_air_pollution,
+    get_bundle,
+    get_city_bundles,
     analyze_air_pollution
 )
 
+# Асинхронный клиент - когда запросов сразу много (уведомления подписчикам)
+from weather_async import fetch_locations
+
+# Приоритеты общей квоты API: пользователь в чате > inline > фоновые задачи
+from quota import api_priority, INLINE, BACKGROUND
+
 # Импортируем модуль хранилища
 from storage import (
     load_user,
@@ -36,8 +44,9 @@ if not BOT_TOKEN:
 
 bot = telebot.TeleBot(BOT_TOKEN)
 
-# Выполняем миграцию данных пользователей при запуске
-migrate_user_data()
+# Миграция данных пользователей: если данные уже актуальны - ничего не делает,
+# иначе обновляет записи в фоне, не задерживая запуск бота
+migrate_user_data(background=True)
 
 # ============== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==============
 
@@ -67,6 +76,18 @@ def get_wind_direction(deg: int) -> str:
     idx = round(deg / 45) % 8
     return directions[idx]
 
+def format_data_age(*datasets: dict) -> str:
+    """
+    Пометка «данные от ЧЧ:ММ», если API недоступен и показаны
+    последние сохранённые данные (ключ _stale_at от weather_cached)
+    """
+    stale_at = [data['_stale_at'] for data in datasets if data and data.get('_stale_at')]
+    if not stale_at:
+        return ""
+    dt = datetime.fromtimestamp(min(stale_at))
+    time_str = dt.strftime('%H:%M') if dt.date() == datetime.now().date() else dt.strftime('%d.%m %H:%M')
+    return f"\n⚠️ <i>Сервис погоды недоступен, данные от {time_str}</i>\n"
+
 def format_basic_weather(weather: dict) -> str:
     """Форматирует базовую информацию о погоде"""
     emoji = get_weather_emoji(weather['weather'][0]['description'])
@@ -85,7 +106,7 @@ def format_basic_weather(weather: dict) -> str:
 
 📝 <b>Описание:</b> {weather['weather'][0]['description'].capitalize()}
 """
-    return text
+    return text + format_data_age(weather)
 
 def format_extended_weather(weather: dict, air_pollution: dict) -> str:
     """Форматирует расширенную информацию о погоде"""
@@ -147,7 +168,7 @@ def format_extended_weather(weather: dict, air_pollution: dict) -> str:
 📝 <b>Описание:</b> {weather['weather'][0]['description'].capitalize()}
 🕐 <b>Обновлено:</b> {datetime.now().strftime('%H:%M:%S')}
 """
-    return text
+    return text + format_data_age(weather, air_pollution)
 
 def format_comparison(weather1: dict, weather2: dict) -> str:
     """Форматирует сравнение двух городов"""
@@ -196,7 +217,7 @@ def format_comparison(weather1: dict, weather2: dict) -> str:
 📝 <b>{weather1['name']}:</b> {weather1['weather'][0]['description']}
 📝 <b>{weather2['name']}:</b> {weather2['weather'][0]['description']}
 """
-    return text
+    return text + format_data_age(weather1, weather2)
 
 # ============== ПРОГНОЗ НА 5 ДНЕЙ ==============
 
@@ -511,7 +532,7 @@ def show_forecast(chat_id: int, user_id: int, lat: float, lon: float, city_name:
             }
             
             keyboard = create_forecast_keyboard(forecast, user_id)
-            text = f"<b>📅 Прогноз на 5 дней — {city_name}</b>\n\nВыберите день для подробностей:"
+            text = f"<b>📅 Прогноз на 5 дней — {city_name}</b>\n{format_data_age(forecast)}\nВыберите день для подробностей:"
             
             bot.send_message(chat_id, text, parse_mode='HTML',
                            reply_markup=keyboard)
@@ -649,8 +670,9 @@ def compare_command(message):
 def show_comparison(chat_id: int, city1: str, city2: str):
     """Показывает сравнение двух городов"""
     try:
-        weather1 = get_current_weather(city=city1.strip())
-        weather2 = get_current_weather(city=city2.strip())
+        # Оба города запрашиваются одновременно
+        city_data = get_city_bundles([city1.strip(), city2.strip()])
+        weather1, weather2 = (data and data["weather"] for data in city_data)
         
         if weather1 and weather2:
             text = format_comparison(weather1, weather2)
@@ -757,8 +779,9 @@ def show_extended(chat_id: int, city: str = None, lat: float = None, lon: float
                                reply_markup=get_main_keyboard())
                 return
         
-        weather = get_weather_by_coordinates(lat, lon)
-        air_pollution = get_air_pollution(lat, lon)
+        # Погода и качество воздуха запрашиваются одновременно
+        bundle = get_bundle(lat, lon, parts=("weather", "air_pollution"))
+        weather, air_pollution = bundle["weather"], bundle["air_pollution"]
         
         if weather and air_pollution:
             text = format_extended_weather(weather, air_pollution)
@@ -1227,7 +1250,8 @@ def inline_query_handler(query):
             return
         
         # Получаем погоду для города
-        weather = get_current_weather(city=city)
+        with api_priority(INLINE):
+            weather = get_current_weather(city=city)
         
         if not weather:
             # Город не найден
@@ -1257,7 +1281,7 @@ def inline_query_handler(query):
 📝 {description.capitalize()}
 💧 Влажность: {weather['main']['humidity']}%
 🌪️ Ветер: {weather['wind']['speed']} м/с
-
+{format_data_age(weather)}
 <i>Отправлено через Weather Bot</i>
 """
         
@@ -1383,6 +1407,74 @@ def handle_text(message):
 
 # ============== СИСТЕМА УВЕДОМЛЕНИЙ (ФОНОВЫЙ ПОТОК) ==============
 
+NOTIFICATION_BATCH = 500  # подписчиков в одной пачке одновременных запросов
+
+def send_weather_alert(user_id: int, user_data, data: dict) -> None:
+    """
+    Отправляет подписчику уведомление об опасной погоде, если она ожидается
+
+    Args:
+        user_id: ID пользователя
+        user_data: Данные пользователя
+        data: {"forecast": прогноз, "weather": текущая погода} из fetch_locations
+    """
+    city_name = user_data.get('city', 'вашем местоположении')
+
+    # Получаем прогноз. Данные на случай сбоя API (_stale_at) могут быть
+    # многочасовой давности - по ним уведомление сообщило бы о прошедшем
+    forecast = data['forecast']
+    if not forecast or forecast.get('_stale_at'):
+        return
+
+    current_weather = data['weather']
+    if current_weather and current_weather.get('_stale_at'):
+        current_weather = None
+    
+    alerts = []
+
+    # Проверяем ближайшие 12 часов. Прогноз из кэша может быть получен
+    # несколько часов назад (stale-while-revalidate), поэтому прошедшие
+    # записи пропускаются
+    now = time.time()
+    upcoming = [item for item in forecast['list'] if item['dt'] > now][:4]  # 4 записи = 12 часов
+    for item in upcoming:
+        weather_main = item['weather'][0]['main'].lower()
+        description = item['weather'][0]['description']
+        dt = datetime.fromtimestamp(item['dt'])
+        time_str = dt.strftime('%H:%M')
+        
+        # Проверяем опасные явления
+        if 'rain' in weather_main or 'дождь' in description:
+            alerts.append(f"🌧️ Ожидается дождь в {time_str}")
+        elif 'snow' in weather_main or 'снег' in description:
+            alerts.append(f"❄️ Ожидается снег в {time_str}")
+        elif 'thunderstorm' in weather_main or 'гроз' in description:
+            alerts.append(f"⛈️ Ожидается гроза в {time_str}")
+    
+    # Проверяем резкое изменение температуры
+    if current_weather and upcoming:
+        current_temp = current_weather['main']['temp']
+        future_temp = upcoming[-1]['main']['temp']  # через 9 часов
+        temp_diff = future_temp - current_temp
+        
+        if abs(temp_diff) >= 5:
+            direction = "потеплеет" if temp_diff > 0 else "похолодает"
+            alerts.append(f"🌡️ К вечеру {direction} на {abs(temp_diff):.0f}°C")
+    
+    # Отправляем уведомления
+    if alerts:
+        # Убираем дубликаты
+        alerts = list(dict.fromkeys(alerts))
+        
+        text = f"<b>⚠️ Погодное уведомление — {city_name}</b>\n\n"
+        text += "\n".join(alerts[:5])  # Максимум 5 оповещений
+        text += "\n\n<i>Отключить: /unsubscribe</i>"
+        
+        try:
+            bot.send_message(user_id, text, parse_mode='HTML')
+        except:
+            pass  # Пользователь мог заблокировать бота
+
 def check_weather_alerts():
     """Проверяет погоду для подписчиков и отправляет уведомления"""
     while True:
@@ -1390,82 +1482,30 @@ def check_weather_alerts():
             # Получаем текущий час
             current_hour = datetime.now().hour
 
-            subscribed_users = get_subscribed_users()
-
-            for user_id, user_data in subscribed_users.items():
-                # Проверяем, находится ли текущий час в разрешенном периоде
-                notifications = user_data.get('notifications', {})
-                start_hour = notifications.get('start_hour', 9)
-                end_hour = notifications.get('end_hour', 21)
-
-                # Если период охватывает полные сутки (например, 00:00 - 23:59)
-                if start_hour <= end_hour:
-                    in_allowed_period = start_hour <= current_hour < end_hour
-                else:
-                    # Если период переходит через полночь (например, 22:00 - 06:00)
-                    in_allowed_period = current_hour >= start_hour or current_hour < end_hour
-
-                if not in_allowed_period:
-                    continue
-                if not user_data.get('lat') or not user_data.get('lon'):
-                    continue
-                
-                try:
-                    lat = user_data['lat']
-                    lon = user_data['lon']
-                    city_name = user_data.get('city', 'вашем местоположении')
-                    
-                    # Получаем прогноз
-                    forecast = get_hourly_weather(lat, lon)
-                    if not forecast:
+            # Только подписчики, у которых текущий час входит в период уведомлений
+            subscribed_users = get_subscribed_users(hour=current_hour)
+            recipients = [(user_id, user_data) for user_id, user_data in subscribed_users.items()
+                          if user_data.get('lat') and user_data.get('lon')]
+
+            # Прогноз и текущая погода запрашиваются одновременно для пачки
+            # подписчиков, а не по очереди для каждого; уведомления пачки
+            # отправляются сразу, не дожидаясь остальных. Приоритет квоты
+            # фоновый: при её нехватке уведомления ждут или пропускаются,
+            # а не отнимают запросы у пользователей
+            for start in range(0, len(recipients), NOTIFICATION_BATCH):
+                batch = recipients[start:start + NOTIFICATION_BATCH]
+                with api_priority(BACKGROUND):
+                    fetched = fetch_locations(((user_data['lat'], user_data['lon']) for _, user_data in batch),
+                                              ("forecast", "weather"))
+
+                for (user_id, user_data), data in zip(batch, fetched):
+                    if not data:
+                        continue
+                    try:
+                        send_weather_alert(user_id, user_data, data)
+                    except Exception as e:
                         continue
-                    
-                    current_weather = get_weather_by_coordinates(lat, lon)
-                    
-                    alerts = []
-                    
-                    # Проверяем ближайшие 12 часов
-                    for item in forecast['list'][:4]:  # 4 записи = 12 часов
-                        weather_main = item['weather'][0]['main'].lower()
-                        description = item['weather'][0]['description']
-                        dt = datetime.fromtimestamp(item['dt'])
-                        time_str = dt.strftime('%H:%M')
-                        
-                        # Проверяем опасные явления
-                        if 'rain' in weather_main or 'дождь' in description:
-                            alerts.append(f"🌧️ Ожидается дождь в {time_str}")
-                        elif 'snow' in weather_main or 'снег' in description:
-                            alerts.append(f"❄️ Ожидается снег в {time_str}")
-                        elif 'thunderstorm' in weather_main or 'гроз' in description:
-                            alerts.append(f"⛈️ Ожидается гроза в {time_str}")
-                    
-                    # Проверяем резкое изменение температуры
-                    if current_weather and forecast['list']:
-                        current_temp = current_weather['main']['temp']
-                        future_temp = forecast['list'][3]['main']['temp']  # через 9 часов
-                        temp_diff = future_temp - current_temp
-                        
-                        if abs(temp_diff) >= 5:
-                            direction = "потеплеет" if temp_diff > 0 else "похолодает"
-                            alerts.append(f"🌡️ К вечеру {direction} на {abs(temp_diff):.0f}°C")
-                    
-                    # Отправляем уведомления
-                    if alerts:
-                        # Убираем дубликаты
-                        alerts = list(dict.fromkeys(alerts))
-                        
-                        text = f"<b>⚠️ Погодное уведомление — {city_name}</b>\n\n"
-                        text += "\n".join(alerts[:5])  # Максимум 5 оповещений
-                        text += "\n\n<i>Отключить: /unsubscribe</i>"
-                        
-                        try:
-                            bot.send_message(user_id, text, parse_mode='HTML')
-                        except:
-                            pass  # Пользователь мог заблокировать бота
-                            
-                except Exception as e:
-                    continue
-                    
+
         except Exception as e:
             pass
         
@@ -0,0 +1,149 @@
+"""
+Автоматические выключатели (circuit breaker) запросов к OpenWeatherMap API
+
+У каждого endpoint свой выключатель. Он помнит исходы последних
+BREAKER_WINDOW запросов и размыкается, если среди них не меньше
+BREAKER_ERROR_RATE ошибок (5xx, 429, сеть, таймаут) или не меньше
+BREAKER_SLOW_RATE медленных ответов (дольше BREAKER_SLOW_CALL секунд).
+Разомкнутый выключатель BREAKER_OPEN_SECONDS секунд сразу отказывает
+(CircuitOpen) без обращения к API, затем пропускает один пробный запрос:
+успех замыкает его, ошибка снова размыкает.
+
+Пока API недоступен, обработчики не ждут таймаутов и повторов, а weather_cached
+отдаёт последние сохранённые данные с пометкой времени.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import Dict, Any, Deque, Tuple
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))  # последних запросов
+BREAKER_MIN_CALLS = 5  # раньше решение не принимается
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", "3"))  # секунды
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Выключатель endpoint разомкнут: запрос отклонён без обращения к API"""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"API {endpoint} недоступен, повтор через {retry_in:.0f} с")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+def is_failure_status(status: int) -> bool:
+    """Код ответа говорит о сбое API, а не о неверном запросе (0 - сеть или таймаут)"""
+    return status == 0 or status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    """Выключатель одного endpoint; потокобезопасен, годится и для цикла событий"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.state = CLOSED
+        self._calls: Deque[Tuple[bool, bool]] = deque(maxlen=BREAKER_WINDOW)  # (ошибка, медленный)
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._probing = False
+        self._trips = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """
+        Проверяет, можно ли сейчас обратиться к API; вызывается перед каждой попыткой
+
+        Raises:
+            CircuitOpen: Выключатель разомкнут (или пробный запрос уже идёт)
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN:
+                retry_in = self._opened_at + BREAKER_OPEN_SECONDS - now
+                if retry_in > 0:
+                    self._rejected += 1
+                    raise CircuitOpen(self.endpoint, retry_in)
+                self.state = HALF_OPEN
+            # Полуоткрыт: пробный запрос уже идёт. Если его исход так и не
+            # записан (поток упал), через BREAKER_OPEN_SECONDS пускаем новый.
+            elif self._probing and now - self._probe_started < BREAKER_OPEN_SECONDS:
+                self._rejected += 1
+                raise CircuitOpen(self.endpoint, BREAKER_OPEN_SECONDS - (now - self._probe_started))
+            self._probing = True
+            self._probe_started = now
+
+    def release(self) -> None:
+        """
+        Возвращает разрешение allow(), если запрос так и не ушёл к API
+        (например, отброшен квотой): пробный запрос полуоткрытого выключателя
+        сможет сделать следующий вызов, не дожидаясь BREAKER_OPEN_SECONDS
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def record(self, failure: bool, latency: float) -> None:
+        """Записывает исход попытки: ошибка API и длительность в секундах"""
+        slow = latency > BREAKER_SLOW_CALL
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failure or slow:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._calls.clear()
+                return
+
+            self._calls.append((failure, slow))
+            if self.state != CLOSED or len(self._calls) < BREAKER_MIN_CALLS:
+                return
+            calls = len(self._calls)
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slow_calls = sum(1 for _, was_slow in self._calls if was_slow)
+            if failures / calls >= BREAKER_ERROR_RATE or slow_calls / calls >= BREAKER_SLOW_RATE:
+                self._open()
+
+    def _open(self) -> None:
+        """Размыкает выключатель (под _lock)"""
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._trips += 1
+        print(f"⚠️ API {self.endpoint} деградировал, запросы приостановлены на {BREAKER_OPEN_SECONDS:.0f} с")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Состояние выключателя: state, trips (размыканий), rejected (отклонённых запросов)"""
+        with self._lock:
+            return {"state": self.state, "trips": self._trips, "rejected": self._rejected}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """Возвращает выключатель endpoint (общий для синхронного и асинхронного клиента)"""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+    return breaker
+
+
+def breakers_snapshot() -> Dict[str, Dict[str, Any]]:
+    """Состояние выключателей всех endpoint: {endpoint: CircuitBreaker.snapshot()}"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.endpoint: breaker.snapshot() for breaker in breakers}
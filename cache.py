@@ -1,16 +1,356 @@
 """
 Модуль для кэширования API запросов к OpenWeatherMap
-Кэш хранится в ./.cache/*.json и действителен 10 минут
+Кэш хранится в одном файле SQLite ./.cache/cache.db
+
+Срок годности задаётся для каждого endpoint (CACHE_TTL). После его окончания
+запись ещё CACHE_STALE_WINDOW[endpoint] секунд остаётся в кэше устаревшей:
+get_entry отдаёт её с пометкой stale, чтобы вызывающий код мог сразу ответить
+пользователю и обновить данные в фоне (stale-while-revalidate).
+Ещё CACHE_FALLBACK_WINDOW[endpoint] секунд запись хранится на случай сбоя API:
+get_fallback отдаёт её, когда свежие данные получить не удалось.
+
+У записи есть индексированная колонка expires_at, поэтому очистка устаревших
+записей и статистика - запросы по диапазону, без чтения самих данных.
+Старые файлы ./.cache/*.json переносятся в базу при первом обращении.
+
+Перед дисковым кэшем стоит ограниченный LRU-кэш в памяти: повторный запрос
+недавней локации не обращается к базе и не разбирает JSON. Размер задаётся
+переменными CACHE_MEMORY_ENTRIES (записей) и CACHE_MEMORY_BYTES (байт).
+
+Координаты в ключе квантуются по сетке с шагом CACHE_GRID_KM[endpoint] км:
+соседние пользователи из одной ячейки получают одну запись кэша.
+
+Размер базы ограничен фоновым уборщиком: раз в CACHE_JANITOR_INTERVAL секунд
+он удаляет записи старше окна устаревания, а сверх CACHE_MAX_ENTRIES записей
+или CACHE_MAX_BYTES байт вытесняет сначала устаревшие записи, затем давно
+не читанные (CACHE_EVICTION=lru) или редко читаемые (CACHE_EVICTION=lfu).
+
+Счётчики попаданий, промахов, вытеснений, записей и байт по каждому endpoint
+ведутся на лету: stats_snapshot() не обращается к базе.
+
+Данные записи кодируются кодеком своего endpoint (CACHE_CODECS): сериализатор
+json (компактный), marshal или msgpack, с необязательным сжатием zlib или lz4,
+например "json+zlib". Кодек хранится в каждой записи, поэтому после смены
+настроек старые записи читаются как раньше; перекодировать их сразу:
+    python cache.py recode
+
+Ошибки API тоже кэшируются (negative caching): set_negative запоминает код
+ответа - 404 «город не найден», 4xx, 5xx - в той же базе под отдельным ключом
+и с коротким сроком CACHE_NEGATIVE_TTL, чтобы повторные запросы неизвестного
+города или упавшего API не доходили до сервера. Отрицательная запись не
+затирает положительную, даже устаревшую.
+
+Координаты городов (геокодирование) хранятся в той же базе с долгим сроком
+CACHE_TTL["geo"]. Ключ - нормализованное название (normalize_city): регистр,
+пробелы и дефисы, «ё»/«е» и распространённые варианты транслитерации не
+различаются, поэтому «Нижний Новгород», «нижний-новгород» и «Nizhniy Novgorod»
+попадают в одну запись.
+
+В той же базе, в отдельной таблице quota, хранится уровень суточной квоты
+API (quota.py), чтобы перезапуск процесса не обнулял израсходованное.
+Очистка и вытеснение кэша её не затрагивают.
 """
 
 import os
+import re
+import sys
 import json
-import hashlib
+import math
 import time
-from typing import Optional, Any, Dict
+import zlib
+import marshal
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, Any, Dict, Tuple, NamedTuple, Callable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 CACHE_DIR = ".cache"
-CACHE_DURATION = 600  # 10 минут в секундах
+CACHE_DB_FILE = os.path.join(CACHE_DIR, "cache.db")
+CACHE_DURATION = 600  # 10 минут в секундах - срок годности по умолчанию
+
+# Срок годности записей по endpoint, секунды. Прогноз OpenWeatherMap
+# обновляется шагами по 3 часа, качество воздуха - раз в час.
+CACHE_TTL = {
+    "weather": 600,
+    "forecast": 3600,
+    "air_pollution": 1800,
+    "geo": 30 * 24 * 3600,  # координаты городов почти не меняются
+}
+
+# Сколько секунд после окончания срока годности запись ещё можно отдать
+# устаревшей, пока она обновляется в фоне
+CACHE_STALE_WINDOW = {
+    "weather": 1800,
+    "forecast": 3 * 3600,
+    "air_pollution": 3600,
+}
+
+# Сколько секунд после окна устаревания запись ещё хранится, чтобы при сбое
+# API показать последние известные данные (с пометкой времени) вместо ошибки
+CACHE_FALLBACK_WINDOW = {
+    "weather": 6 * 3600,
+    "forecast": 24 * 3600,
+    "air_pollution": 6 * 3600,
+}
+CACHE_MEMORY_ENTRIES = int(os.getenv("CACHE_MEMORY_ENTRIES", "2048"))
+CACHE_MEMORY_BYTES = int(os.getenv("CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+
+# Шаг сетки квантования координат для каждого endpoint, км (0 - без квантования).
+# Прогноз и качество воздуха меняются в пространстве плавнее текущей погоды,
+# поэтому их ячейки крупнее. Переопределяется переменной CACHE_GRID_KM_<ENDPOINT>,
+# например CACHE_GRID_KM_WEATHER=1.
+CACHE_GRID_KM = {
+    "weather": 2.0,
+    "forecast": 10.0,
+    "air_pollution": 20.0,
+}
+_KM_PER_DEGREE = 111.32  # длина градуса широты
+
+# Ограничения базы кэша и фоновый уборщик
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_JANITOR_INTERVAL = float(os.getenv("CACHE_JANITOR_INTERVAL", "300"))  # секунды
+CACHE_EVICTION = os.getenv("CACHE_EVICTION", "lru")  # "lru" или "lfu"
+
+# Кодек данных записей по endpoint: "<сериализатор>[+<сжатие>]".
+# Прогноз на 5 дней - самый большой ответ, он сжимается; остальные малы.
+# Переопределяется переменной CACHE_CODEC_<ENDPOINT>, например
+# CACHE_CODEC_FORECAST=msgpack+lz4 (нужны пакеты msgpack и lz4).
+CACHE_CODECS = {
+    "weather": "json",
+    "forecast": "json+zlib",
+    "air_pollution": "json",
+}
+CACHE_DEFAULT_CODEC = os.getenv("CACHE_CODEC", "json")
+
+# Срок хранения отрицательных результатов по коду ответа API, секунды.
+# Намного короче положительных: неизвестный город вряд ли появится за
+# несколько минут, а сбой сервера или превышение лимита проходят быстрее.
+CACHE_NEGATIVE_TTL = {
+    404: 600,   # город или данные не найдены
+    429: 30,    # превышен лимит запросов
+    "4xx": 120,
+    "5xx": 30,  # и сетевые ошибки (код 0)
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    lat REAL,
+    lon REAL,
+    cached_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    last_access REAL NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    codec TEXT NOT NULL DEFAULT 'json'
+);
+CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache (expires_at);
+CREATE TABLE IF NOT EXISTS quota (
+    name TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+_SERIALIZERS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    "json": (lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+             json.loads),
+    "marshal": (marshal.dumps, marshal.loads),
+}
+if msgpack is not None:
+    _SERIALIZERS["msgpack"] = (msgpack.packb, lambda raw: msgpack.unpackb(raw, raw=False))
+
+_COMPRESSORS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "zlib": (zlib.compress, zlib.decompress),
+}
+if lz4_frame is not None:
+    _COMPRESSORS["lz4"] = (lz4_frame.compress, lz4_frame.decompress)
+
+# Ошибки разбора повреждённых данных записи
+_DECODE_ERRORS = (ValueError, TypeError, EOFError, RuntimeError, zlib.error)
+
+_unavailable_warned = set()
+
+
+def _split_codec(codec: str) -> Tuple[str, Optional[str]]:
+    """Разбирает "json+zlib" на ("json", "zlib")"""
+    serializer, _, compressor = codec.partition("+")
+    return serializer, compressor or None
+
+
+def get_codec(endpoint: str) -> str:
+    """
+    Кодек записей endpoint с учётом переопределения из окружения
+
+    Если нужный пакет (msgpack, lz4) не установлен, используется json
+    с тем же сжатием (или без него), а предупреждение печатается один раз.
+    """
+    codec = os.getenv(f"CACHE_CODEC_{endpoint.upper()}") or CACHE_CODECS.get(endpoint, CACHE_DEFAULT_CODEC)
+    serializer, compressor = _split_codec(codec)
+    if serializer in _SERIALIZERS and (compressor is None or compressor in _COMPRESSORS):
+        return codec
+
+    if codec not in _unavailable_warned:
+        _unavailable_warned.add(codec)
+        print(f"⚠️ Кодек кэша {codec} недоступен, используется json")
+    return "json+zlib" if compressor == "zlib" else "json"
+
+
+def _encode_sized(data: Any, codec: str) -> Tuple[bytes, int]:
+    """Кодирует данные записи кодеком: (байты для базы, размер до сжатия)"""
+    serializer, compressor = _split_codec(codec)
+    raw = _SERIALIZERS[serializer][0](data)
+    size = len(raw)
+    if compressor is not None:
+        raw = _COMPRESSORS[compressor][0](raw)
+    return raw, size
+
+
+def _decode_sized(raw: bytes, codec: str) -> Tuple[Any, int]:
+    """Декодирует данные записи: (данные, размер после распаковки)"""
+    serializer, compressor = _split_codec(codec)
+    if compressor is not None:
+        raw = _COMPRESSORS[compressor][1](raw)
+    return _SERIALIZERS[serializer][1](raw), len(raw)
+
+
+def encode(data: Any, codec: str) -> bytes:
+    """Кодирует данные записи кодеком"""
+    return _encode_sized(data, codec)[0]
+
+
+def decode(raw: bytes, codec: str) -> Any:
+    """Декодирует данные записи, закодированные кодеком"""
+    return _decode_sized(raw, codec)[0]
+
+
+class CacheEntry(NamedTuple):
+    """Запись кэша: данные и время их получения"""
+    data: Any
+    cached_at: float
+    expires_at: float
+    size: int
+
+    @property
+    def stale(self) -> bool:
+        """Срок годности истёк (данные можно отдать, но пора обновить)"""
+        return time.time() > self.expires_at
+
+
+class _MemoryCache:
+    """
+    LRU-кэш в памяти с ограничением по количеству записей и по размеру
+
+    Хранит те же записи, что и база (со сроком годности), поэтому устаревают
+    они одновременно. Размер записи - размер сериализованных данных без
+    сжатия: в памяти лежат разобранные данные, и сжатое представление
+    занижало бы их объём в несколько раз. Данные отдаются
+    без копирования: вызывающий код не должен их изменять.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Возвращает запись (в том числе устаревшую) или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        """Кладёт запись, вытесняя самые давно использованные сверх лимитов"""
+        if self.max_entries <= 0 or entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+
+_memory = _MemoryCache(CACHE_MEMORY_ENTRIES, CACHE_MEMORY_BYTES)
+
+# Одно соединение на процесс, доступ сериализован блокировкой:
+# кэш читают обработчики telebot из разных потоков и поток уведомлений
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+# Обращения к записям копятся в памяти и записываются в базу уборщиком
+# пачкой: чтение из памяти не должно писать в базу. {key: (last_access, hits)}
+_access: Dict[str, Tuple[float, int]] = {}
+_access_lock = threading.Lock()
+_janitor_thread: Optional[threading.Thread] = None
+
+# Счётчики по endpoint. entries и bytes считаются из базы один раз при её
+# открытии и дальше поддерживаются при каждой записи и удалении.
+# negative_hits и fallback_hits считаются отдельно и в hit_rate не входят.
+_STAT_COUNTERS = ("hits", "memory_hits", "stale_hits", "misses", "negative_hits", "fallback_hits",
+                  "evictions", "expired", "entries", "bytes")
+_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def _count(endpoint: str, **deltas: int) -> None:
+    """Прибавляет значения к счётчикам endpoint"""
+    with _stats_lock:
+        counters = _stats.get(endpoint)
+        if counters is None:
+            counters = _stats[endpoint] = dict.fromkeys(_STAT_COUNTERS, 0)
+        for name, delta in deltas.items():
+            counters[name] += delta
+
+
+def _reset_sizes(db: sqlite3.Connection) -> None:
+    """Пересчитывает записи и байты по endpoint из базы (при открытии и очистке)"""
+    with _stats_lock:
+        for counters in _stats.values():
+            counters["entries"] = counters["bytes"] = 0
+    for endpoint, count, size in db.execute(
+            "SELECT endpoint, COUNT(*), COALESCE(SUM(size), 0) FROM cache GROUP BY endpoint"):
+        _count(endpoint, entries=count, bytes=size)
 
 
 def _ensure_cache_dir():
@@ -19,207 +359,688 @@ def _ensure_cache_dir():
         os.makedirs(CACHE_DIR)
 
 
-def _get_cache_key(lat: float, lon: float, endpoint: str) -> str:
+def _get_db() -> sqlite3.Connection:
+    """Возвращает соединение с базой кэша, при первом обращении открывает её (под _db_lock)"""
+    global _db
+    if _db is None:
+        _ensure_cache_dir()
+        db = sqlite3.connect(CACHE_DB_FILE, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(_SCHEMA)
+        _upgrade_schema(db)
+        _import_legacy_files(db)
+        db.commit()
+        _reset_sizes(db)
+        _db = db
+    return _db
+
+
+def _upgrade_schema(db: sqlite3.Connection) -> None:
+    """Добавляет колонки метаданных в базу, созданную до их появления"""
+    columns = {row[1] for row in db.execute("PRAGMA table_info(cache)")}
+    if "last_access" not in columns:
+        db.execute("ALTER TABLE cache ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+        db.execute("UPDATE cache SET last_access = cached_at")
+    if "hits" not in columns:
+        db.execute("ALTER TABLE cache ADD COLUMN hits INTEGER NOT NULL DEFAULT 0")
+    if "codec" not in columns:
+        # Записи до появления кодеков - JSON
+        db.execute("ALTER TABLE cache ADD COLUMN codec TEXT NOT NULL DEFAULT 'json'")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache (last_access)")
+
+
+def _import_legacy_files(db: sqlite3.Connection) -> None:
+    """Переносит действующие записи из старых файлов .cache/*.json в базу и удаляет файлы"""
+    now = time.time()
+    for filename in os.listdir(CACHE_DIR):
+        if not filename.endswith(".json"):
+            continue
+
+        filepath = os.path.join(CACHE_DIR, filename)
+        try:
+            with open(filepath, "r", encoding="utf-8") as f:
+                cache_data = json.load(f)
+            cached_at = cache_data.get("cached_at", 0)
+            if now - cached_at <= CACHE_DURATION and cache_data.get("data") is not None:
+                lat, lon, endpoint = cache_data["lat"], cache_data["lon"], cache_data["endpoint"]
+                codec = get_codec(endpoint)
+                raw = encode(cache_data["data"], codec)
+                db.execute(
+                    "INSERT OR REPLACE INTO cache "
+                    "(key, endpoint, lat, lon, cached_at, expires_at, size, data, last_access, codec) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (get_cache_key(lat, lon, endpoint), endpoint, lat, lon,
+                     cached_at, cached_at + get_ttl(endpoint), len(raw), raw, cached_at, codec)
+                )
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError, OSError):
+            pass
+
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+def _grid_km(endpoint: str) -> float:
+    """Шаг сетки endpoint с учётом переопределения из окружения"""
+    value = os.getenv(f"CACHE_GRID_KM_{endpoint.upper()}")
+    if value is not None:
+        return float(value)
+    return CACHE_GRID_KM.get(endpoint, 0.0)
+
+
+def quantize_location(lat: float, lon: float, endpoint: str) -> Tuple[float, float]:
+    """
+    Приводит координаты к центру ячейки сетки endpoint
+
+    Ячейки примерно квадратные: шаг по долготе растёт с широтой,
+    чтобы ячейка оставалась шириной около CACHE_GRID_KM км.
+
+    Args:
+        lat: Широта
+        lon: Долгота
+        endpoint: Название API endpoint
+
+    Returns:
+        tuple: (lat, lon) центра ячейки; исходные координаты без квантования
+    """
+    grid_km = _grid_km(endpoint)
+    if grid_km <= 0:
+        return lat, lon
+
+    lat_step = grid_km / _KM_PER_DEGREE
+    cell_lat = (math.floor(lat / lat_step) + 0.5) * lat_step
+    lon_step = lat_step / max(math.cos(math.radians(cell_lat)), 0.01)
+    cell_lon = (math.floor(lon / lon_step) + 0.5) * lon_step
+    return cell_lat, cell_lon
+
+
+def get_ttl(endpoint: str) -> float:
+    """Срок годности записей endpoint, секунды"""
+    return CACHE_TTL.get(endpoint, CACHE_DURATION)
+
+
+def get_stale_window(endpoint: str) -> float:
+    """Сколько секунд после срока годности запись endpoint можно отдавать устаревшей"""
+    return CACHE_STALE_WINDOW.get(endpoint, 0)
+
+
+def get_fallback_window(endpoint: str) -> float:
+    """Сколько секунд после окна устаревания запись endpoint хранится на случай сбоя API"""
+    return CACHE_FALLBACK_WINDOW.get(endpoint, 0)
+
+
+def get_negative_ttl(status: int) -> float:
+    """Срок хранения отрицательного результата с кодом ответа status, секунды"""
+    if status in CACHE_NEGATIVE_TTL:
+        return CACHE_NEGATIVE_TTL[status]
+    return CACHE_NEGATIVE_TTL["4xx" if 400 <= status < 500 else "5xx"]
+
+
+# Транслитерация кириллицы в латиницу для ключей городов
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+    "ж": "zh", "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+})
+
+_CYRILLIC = re.compile(r"[а-яё]")
+
+# Сведение вариантов транслитерации русских названий к одному (порядок важен):
+# Yekaterinburg/Ekaterinburg, Khabarovsk/Habarovsk, Nizhniy/Nizhny/Nizhnij.
+# Применяется только к названиям, введённым кириллицей: для латинских
+# названий эти буквы различают разные города (Jining и Yining, Kharkiv и Harkiv)
+_TRANSLIT_FOLDS = [
+    (re.compile(r"\bye"), "e"),
+    (re.compile(r"shch|sch"), "sh"),
+    (re.compile(r"kh"), "h"),
+    (re.compile(r"tz"), "ts"),
+    (re.compile(r"[yj]"), "i"),
+    (re.compile(r"w"), "v"),
+    (re.compile(r"i+"), "i"),
+]
+
+
+def normalize_city(city: str) -> str:
+    """
+    Приводит название города к виду для ключа кэша
+
+    Регистр, лишние пробелы, дефисы, «ё»/«е» и кириллица/латиница
+    не различаются: «Ростов-на-Дону» и «rostov na donu» дают один результат.
+    Варианты транслитерации (_TRANSLIT_FOLDS) сводятся только для названий,
+    введённых кириллицей.
+    """
+    name = city.strip().lower()
+    cyrillic = _CYRILLIC.search(name) is not None
+    name = re.sub(r"[^\w]+", " ", name.translate(_TRANSLIT)).strip()
+    if cyrillic:
+        for pattern, replacement in _TRANSLIT_FOLDS:
+            name = pattern.sub(replacement, name)
+    return name
+
+
+def get_city_key(city: str) -> str:
+    """Ключ записи координат города в базе кэша"""
+    return f"geo:{normalize_city(city)}"
+
+
+def get_city_query_key(city: str) -> str:
     """
-    Генерирует ключ кэша на основе координат и endpoint
-    
+    Ключ отрицательной записи геокодирования: запрос как есть (без учёта
+    регистра и пробелов по краям). Свёртка normalize_city может склеить разные
+    запросы, и «не найден» для одного написания не должен скрывать другое.
+    """
+    return f"geo:query:{city.strip().lower()}"
+
+
+def get_cache_key(lat: float, lon: float, endpoint: str) -> str:
+    """
+    Генерирует ключ кэша на основе ячейки сетки координат и endpoint
+
     Args:
         lat: Широта
         lon: Долгота
         endpoint: Название API endpoint (weather, forecast, air_pollution и т.д.)
-        
+
     Returns:
-        str: MD5 хэш для использования в качестве имени файла
+        str: Ключ записи в базе кэша
     """
-    key_string = f"{lat:.4f}_{lon:.4f}_{endpoint}"
-    return hashlib.md5(key_string.encode()).hexdigest()
+    lat, lon = quantize_location(lat, lon, endpoint)
+    return f"{endpoint}:{lat:.4f}:{lon:.4f}"
+
+
+def get_entry(lat: float, lon: float, endpoint: str, max_stale: float = None,
+              counted: bool = True) -> Optional[CacheEntry]:
+    """
+    Получает запись кэша вместе со временем её получения
+
+    Args:
+        lat: Широта
+        lon: Долгота
+        endpoint: Название API endpoint
+        max_stale: Сколько секунд после срока годности запись ещё отдаётся
+                   (по умолчанию - окно CACHE_STALE_WINDOW endpoint)
+        counted: Учитывать поиск в попаданиях и промахах (False - повторная
+                 проверка того же запроса)
+
+    Returns:
+        CacheEntry или None: Запись (entry.stale - срок годности истёк)
+        или None если записи нет или она старше окна
+    """
+    if max_stale is None:
+        max_stale = get_stale_window(endpoint)
+    return _get_entry(get_cache_key(lat, lon, endpoint), endpoint, max_stale, counted)
+
+
+def _get_entry(cache_key: str, endpoint: str, max_stale: float,
+               counted: bool = True) -> Optional[CacheEntry]:
+    """
+    Получает запись кэша по ключу (см. get_entry); counted=False - служебный
+    поиск (отрицательные записи, данные на случай сбоя), который не влияет
+    на попадания и промахи
+    """
+    current_time = time.time()
+
+    # Сначала память - без обращения к базе
+    entry = _memory.get(cache_key)
+    from_memory = entry is not None
+    if entry is None:
+        try:
+            with _db_lock:
+                row = _get_db().execute(
+                    "SELECT cached_at, expires_at, data, codec FROM cache WHERE key = ?", (cache_key,)
+                ).fetchone()
+            if row is None:
+                _count(endpoint, misses=int(counted))
+                return None
+            cached_at, expires_at, raw, codec = row
+            data, size = _decode_sized(raw, codec)
+            entry = CacheEntry(data, cached_at, expires_at, size)
+        except _DECODE_ERRORS + (KeyError, sqlite3.Error, OSError):
+            _count(endpoint, misses=int(counted))
+            return None
+        _memory.put(cache_key, entry)
+
+    if current_time - entry.expires_at > max_stale:
+        # Слишком старая запись - удалит clear_old_cache
+        _count(endpoint, misses=int(counted))
+        return None
+
+    if counted:
+        if current_time > entry.expires_at:
+            _count(endpoint, stale_hits=1)
+        else:
+            _count(endpoint, hits=1, memory_hits=int(from_memory))
+
+    with _access_lock:
+        _, hits = _access.get(cache_key, (0, 0))
+        _access[cache_key] = (current_time, hits + 1)
+    return entry
 
 
-def _get_cache_path(cache_key: str) -> str:
-    """Возвращает полный путь к файлу кэша"""
-    return os.path.join(CACHE_DIR, f"{cache_key}.json")
+def get_fallback(lat: float, lon: float, endpoint: str) -> Optional[CacheEntry]:
+    """
+    Получает последнюю сохранённую запись, даже вышедшую за окно устаревания
+    (но не старше CACHE_FALLBACK_WINDOW) - для ответа, когда API недоступен
+
+    Returns:
+        CacheEntry или None: Запись (cached_at - время получения данных) или None
+    """
+    max_stale = get_stale_window(endpoint) + get_fallback_window(endpoint)
+    entry = _get_entry(get_cache_key(lat, lon, endpoint), endpoint, max_stale, counted=False)
+    if entry is not None:
+        _count(endpoint, fallback_hits=1)
+    return entry
 
 
 def get_cached(lat: float, lon: float, endpoint: str) -> Optional[Dict[str, Any]]:
     """
     Получает данные из кэша если они не устарели
-    
+
     Args:
         lat: Широта
         lon: Долгота
         endpoint: Название API endpoint
-        
+
     Returns:
         dict или None: Данные из кэша или None если кэш отсутствует/устарел
     """
-    _ensure_cache_dir()
-    
-    cache_key = _get_cache_key(lat, lon, endpoint)
-    cache_path = _get_cache_path(cache_key)
-    
-    if not os.path.exists(cache_path):
-        return None
-    
-    try:
-        with open(cache_path, "r", encoding="utf-8") as f:
-            cache_data = json.load(f)
-        
-        # Проверяем время кэша
-        cached_time = cache_data.get("cached_at", 0)
-        current_time = time.time()
-        
-        if current_time - cached_time > CACHE_DURATION:
-            # Кэш устарел, удаляем файл
-            os.remove(cache_path)
-            return None
-        
-        return cache_data.get("data")
-        
-    except (json.JSONDecodeError, KeyError, OSError):
-        # Если файл поврежден, удаляем его
-        try:
-            os.remove(cache_path)
-        except OSError:
-            pass
+    entry = get_entry(lat, lon, endpoint, max_stale=0)
+    if entry is None or entry.stale:
         return None
+    return entry.data
 
 
-def set_cached(lat: float, lon: float, endpoint: str, data: Dict[str, Any]) -> None:
+def set_cached(lat: float, lon: float, endpoint: str, data: Dict[str, Any], ttl: float = None) -> None:
     """
     Сохраняет данные в кэш
-    
+
     Args:
         lat: Широта
         lon: Долгота
         endpoint: Название API endpoint
         data: Данные для кэширования
+        ttl: Срок годности, секунды (по умолчанию - CACHE_TTL endpoint)
     """
-    _ensure_cache_dir()
-    
-    cache_key = _get_cache_key(lat, lon, endpoint)
-    cache_path = _get_cache_path(cache_key)
-    
-    cache_data = {
-        "cached_at": time.time(),
-        "lat": lat,
-        "lon": lon,
-        "endpoint": endpoint,
-        "data": data
-    }
-    
+    _put_entry(get_cache_key(lat, lon, endpoint), endpoint, lat, lon, data,
+               get_ttl(endpoint) if ttl is None else ttl)
+
+
+def _put_entry(cache_key: str, endpoint: str, lat: Optional[float], lon: Optional[float],
+               data: Any, ttl: float) -> None:
+    """Сохраняет запись кэша по ключу (см. set_cached)"""
+    cached_at = time.time()
+    expires_at = cached_at + ttl
+    codec = get_codec(endpoint)
+    raw, size = _encode_sized(data, codec)
+    _memory.put(cache_key, CacheEntry(data, cached_at, expires_at, size))
+
     try:
-        with open(cache_path, "w", encoding="utf-8") as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
-    except OSError as e:
+        with _db_lock:
+            db = _get_db()
+            old = db.execute("SELECT size FROM cache WHERE key = ?", (cache_key,)).fetchone()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO cache "
+                    "(key, endpoint, lat, lon, cached_at, expires_at, size, data, last_access, codec) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (cache_key, endpoint, lat, lon, cached_at, expires_at, len(raw), raw, cached_at, codec)
+                )
+            if old is None:
+                _count(endpoint, entries=1, bytes=len(raw))
+            else:
+                _count(endpoint, bytes=len(raw) - old[0])
+    except (sqlite3.Error, OSError):
         # Если не удалось сохранить кэш, просто игнорируем
         pass
 
+    _ensure_janitor()
+
+
+def get_city_coordinates(city: str, counted: bool = True) -> Optional[Tuple[float, float]]:
+    """
+    Получает координаты города из кэша
+
+    Args:
+        city: Название города в любом написании (см. normalize_city)
+        counted: Учитывать поиск в попаданиях и промахах (см. get_entry)
+
+    Returns:
+        tuple или None: (latitude, longitude) или None если записи нет или она устарела
+    """
+    entry = _get_entry(get_city_key(city), "geo", 0, counted)
+    if entry is None or entry.stale:
+        return None
+    lat, lon = entry.data
+    return lat, lon
+
+
+def set_city_coordinates(city: str, lat: float, lon: float, ttl: float = None) -> None:
+    """
+    Сохраняет координаты города в кэш
+
+    Args:
+        city: Название города в любом написании (см. normalize_city)
+        lat: Широта
+        lon: Долгота
+        ttl: Срок годности, секунды (по умолчанию - CACHE_TTL["geo"])
+    """
+    _put_entry(get_city_key(city), "geo", lat, lon, [lat, lon],
+               get_ttl("geo") if ttl is None else ttl)
+
+
+def _negative_key(cache_key: str) -> str:
+    """Ключ отрицательной записи для ключа положительной"""
+    return f"negative:{cache_key}"
+
+
+def _negative_endpoint(endpoint: str) -> str:
+    """
+    Endpoint отрицательных записей: у него свои счётчики и нет окна
+    устаревания, так что clear_old_cache удаляет их сразу по истечении срока
+    """
+    return f"{endpoint}:negative"
+
+
+def get_negative(cache_key: str, endpoint: str) -> Optional[int]:
+    """
+    Проверяет, запомнена ли ошибка API для записи кэша
+
+    Args:
+        cache_key: Ключ положительной записи (get_cache_key или ключ запроса)
+        endpoint: Название API endpoint
+
+    Returns:
+        int или None: Код ответа API или None если ошибки нет или её срок истёк
+    """
+    entry = _get_entry(_negative_key(cache_key), _negative_endpoint(endpoint), 0, counted=False)
+    if entry is None or entry.stale:
+        return None
+    _count(endpoint, negative_hits=1)
+    return entry.data["status"]
+
+
+def set_negative(cache_key: str, endpoint: str, status: int, ttl: float = None) -> None:
+    """
+    Запоминает ошибку API для записи кэша, не затрагивая её положительную запись
+
+    Args:
+        cache_key: Ключ положительной записи (get_cache_key или ключ запроса)
+        endpoint: Название API endpoint
+        status: Код ответа API (404 - не найдено)
+        ttl: Срок хранения, секунды (по умолчанию - CACHE_NEGATIVE_TTL по коду)
+    """
+    _put_entry(_negative_key(cache_key), _negative_endpoint(endpoint), None, None,
+               {"status": status}, get_negative_ttl(status) if ttl is None else ttl)
+
+
+def get_quota_state(name: str) -> Optional[Tuple[float, float]]:
+    """
+    Получает сохранённый уровень корзины квоты
+
+    Args:
+        name: Название корзины
+
+    Returns:
+        tuple или None: (жетонов, time.time() сохранения) или None если не сохранялась
+    """
+    try:
+        with _db_lock:
+            row = _get_db().execute("SELECT level, updated_at FROM quota WHERE name = ?",
+                                    (name,)).fetchone()
+    except (sqlite3.Error, OSError):
+        return None
+    return None if row is None else (row[0], row[1])
+
+
+def set_quota_state(name: str, level: float, updated_at: float) -> None:
+    """
+    Сохраняет уровень корзины квоты
+
+    Args:
+        name: Название корзины
+        level: Жетонов в корзине
+        updated_at: Момент, к которому относится уровень (time.time())
+    """
+    try:
+        with _db_lock:
+            db = _get_db()
+            with db:
+                db.execute("INSERT OR REPLACE INTO quota (name, level, updated_at) VALUES (?, ?, ?)",
+                           (name, level, updated_at))
+    except (sqlite3.Error, OSError):
+        # Не удалось сохранить - после перезапуска корзина пополнится по времени
+        pass
+
 
 def clear_cache() -> int:
     """
     Очищает весь кэш
-    
+
     Returns:
-        int: Количество удаленных файлов
+        int: Количество удаленных записей
     """
-    if not os.path.exists(CACHE_DIR):
-        return 0
-    
-    count = 0
-    for filename in os.listdir(CACHE_DIR):
-        if filename.endswith(".json"):
-            try:
-                os.remove(os.path.join(CACHE_DIR, filename))
-                count += 1
-            except OSError:
-                pass
-    
+    _memory.clear()
+    with _db_lock:
+        db = _get_db()
+        with db:
+            count = db.execute("DELETE FROM cache").rowcount
+        _reset_sizes(db)
     return count
 
 
 def clear_old_cache() -> int:
     """
-    Очищает только устаревший кэш
-    
+    Очищает устаревший кэш, который уже нельзя отдать даже устаревшим или
+    при сбое API (по индексу expires_at, с окнами CACHE_STALE_WINDOW
+    и CACHE_FALLBACK_WINDOW каждого endpoint)
+
     Returns:
-        int: Количество удаленных файлов
+        int: Количество удаленных записей
     """
-    if not os.path.exists(CACHE_DIR):
-        return 0
-    
-    count = 0
     current_time = time.time()
-    
-    for filename in os.listdir(CACHE_DIR):
-        if not filename.endswith(".json"):
-            continue
-            
-        filepath = os.path.join(CACHE_DIR, filename)
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                cache_data = json.load(f)
-            
-            cached_time = cache_data.get("cached_at", 0)
-            if current_time - cached_time > CACHE_DURATION:
-                os.remove(filepath)
-                count += 1
-                
-        except (json.JSONDecodeError, KeyError, OSError):
-            # Если файл поврежден, удаляем его
-            try:
-                os.remove(filepath)
-                count += 1
-            except OSError:
-                pass
-    
-    return count
+    with _db_lock:
+        db = _get_db()
+        removed = [
+            (key, endpoint, size)
+            for key, endpoint, size, expires_at in db.execute(
+                "SELECT key, endpoint, size, expires_at FROM cache WHERE expires_at < ?", (current_time,)
+            ).fetchall()
+            if current_time - expires_at > get_stale_window(endpoint) + get_fallback_window(endpoint)
+        ]
+        with db:
+            db.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key, _, _ in removed])
+
+    for key, endpoint, size in removed:
+        _memory.discard(key)
+        _count(endpoint, expired=1, entries=-1, bytes=-size)
+    return len(removed)
 
 
 def get_cache_stats() -> Dict[str, Any]:
     """
     Возвращает статистику кэша
-    
+
     Returns:
-        dict: Статистика с количеством файлов, размером и т.д.
+        dict: Статистика с количеством записей, размером и т.д.
+        (ключи *_files сохранены с тех пор, когда запись была файлом)
     """
-    if not os.path.exists(CACHE_DIR):
-        return {
-            "total_files": 0,
-            "total_size_bytes": 0,
-            "valid_files": 0,
-            "expired_files": 0
+    with _db_lock:
+        db = _get_db()
+        valid = db.execute(
+            "SELECT COUNT(*) FROM cache WHERE expires_at >= ?", (time.time(),)
+        ).fetchone()[0]
+    totals = stats_snapshot()["total"]
+
+    return {
+        "total_files": totals["entries"],
+        "total_size_bytes": totals["bytes"],
+        "valid_files": valid,
+        "expired_files": totals["entries"] - valid
+    }
+
+
+def stats_snapshot() -> Dict[str, Any]:
+    """
+    Возвращает счётчики кэша без обращения к базе (годится для health check)
+
+    Returns:
+        dict: {
+            "total": {hits, memory_hits, stale_hits, misses, negative_hits,
+                      fallback_hits, evictions, expired, entries, bytes, hit_rate},
+            "endpoints": {endpoint: {те же счётчики без hit_rate}},
+            "memory": {"entries": int, "bytes": int}
         }
-    
-    stats = {
-        "total_files": 0,
-        "total_size_bytes": 0,
-        "valid_files": 0,
-        "expired_files": 0
+        hits - свежие попадания (из них memory_hits - из памяти), stale_hits -
+        отданные устаревшие записи, negative_hits - найденные запомненные ошибки
+        API, fallback_hits - данные, отданные при недоступном API (последние
+        два в hit_rate не входят), evictions - вытеснения по лимитам,
+        expired - удаления по возрасту
+    """
+    with _stats_lock:
+        endpoints = {endpoint: dict(counters) for endpoint, counters in _stats.items()}
+
+    total = {name: sum(counters[name] for counters in endpoints.values()) for name in _STAT_COUNTERS}
+    lookups = total["hits"] + total["stale_hits"] + total["misses"]
+    total["hit_rate"] = (total["hits"] + total["stale_hits"]) / lookups if lookups else 0.0
+
+    return {
+        "total": total,
+        "endpoints": endpoints,
+        "memory": {"entries": len(_memory), "bytes": _memory.bytes}
     }
-    
-    current_time = time.time()
-    
-    for filename in os.listdir(CACHE_DIR):
-        if not filename.endswith(".json"):
-            continue
-        
-        filepath = os.path.join(CACHE_DIR, filename)
-        stats["total_files"] += 1
-        
+
+
+def _flush_access(db: sqlite3.Connection) -> None:
+    """Записывает накопленные обращения к записям в базу (под _db_lock)"""
+    with _access_lock:
+        access = list(_access.items())
+        _access.clear()
+    if access:
+        with db:
+            db.executemany(
+                "UPDATE cache SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?",
+                [(last_access, hits, key) for key, (last_access, hits) in access]
+            )
+
+
+def evict_cache(max_entries: int = None, max_bytes: int = None) -> int:
+    """
+    Удаляет записи старше окна устаревания и вытесняет лишние сверх лимитов
+
+    Порядок вытеснения: сначала устаревшие записи (по expires_at),
+    затем по политике CACHE_EVICTION - давно не читанные (lru)
+    или редко читаемые (lfu). Данные записей не читаются, только метаданные.
+
+    Args:
+        max_entries: Максимум записей (по умолчанию CACHE_MAX_ENTRIES)
+        max_bytes: Максимальный суммарный размер данных (по умолчанию CACHE_MAX_BYTES)
+
+    Returns:
+        int: Количество удаленных записей
+    """
+    max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    with _db_lock:
+        _flush_access(_get_db())
+    removed = clear_old_cache()
+
+    with _db_lock:
+        db = _get_db()
+        count, total_size = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+        if count <= max_entries and total_size <= max_bytes:
+            return removed
+
+        order = "hits, last_access" if CACHE_EVICTION == "lfu" else "last_access"
+        candidates = (
+            ("SELECT key, endpoint, size FROM cache WHERE expires_at < ? ORDER BY expires_at", (time.time(),)),
+            (f"SELECT key, endpoint, size FROM cache ORDER BY {order}", ()),
+        )
+        evicted = {}
+        for query, params in candidates:
+            for key, endpoint, size in db.execute(query, params):
+                if count <= max_entries and total_size <= max_bytes:
+                    break
+                if key in evicted:
+                    continue
+                evicted[key] = (endpoint, size)
+                count -= 1
+                total_size -= size
+
+        with db:
+            db.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in evicted])
+
+    for key, (endpoint, size) in evicted.items():
+        _memory.discard(key)
+        _count(endpoint, evictions=1, entries=-1, bytes=-size)
+    return removed + len(evicted)
+
+
+def _janitor_loop() -> None:
+    """Фоновый уборщик: раз в CACHE_JANITOR_INTERVAL секунд ограничивает размер кэша"""
+    while True:
+        time.sleep(CACHE_JANITOR_INTERVAL)
         try:
-            stats["total_size_bytes"] += os.path.getsize(filepath)
-            
-            with open(filepath, "r", encoding="utf-8") as f:
-                cache_data = json.load(f)
-            
-            cached_time = cache_data.get("cached_at", 0)
-            if current_time - cached_time > CACHE_DURATION:
-                stats["expired_files"] += 1
-            else:
-                stats["valid_files"] += 1
-                
-        except (json.JSONDecodeError, KeyError, OSError):
-            pass
-    
-    return stats
+            evict_cache()
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки кэша: {e}")
+
+
+def _ensure_janitor() -> None:
+    """Запускает фоновый уборщик при первой записи в кэш"""
+    global _janitor_thread
+    if _janitor_thread is not None:
+        return
+    with _access_lock:
+        if _janitor_thread is None:
+            _janitor_thread = threading.Thread(target=_janitor_loop, daemon=True)
+            _janitor_thread.start()
+
+
+def recode_cache() -> int:
+    """
+    Перекодирует записи, закодированные не текущим кодеком своего endpoint
+    (после смены CACHE_CODECS); нечитаемые записи удаляются
+
+    Returns:
+        int: Количество перекодированных записей
+    """
+    recoded = 0
+    with _db_lock:
+        db = _get_db()
+        endpoints = [row[0] for row in db.execute("SELECT DISTINCT endpoint FROM cache")]
+        for endpoint in endpoints:
+            codec = get_codec(endpoint)
+            rows = db.execute(
+                "SELECT key, codec, data FROM cache WHERE endpoint = ? AND codec != ?", (endpoint, codec)
+            ).fetchall()
+            updates, broken = [], []
+            for key, old_codec, raw in rows:
+                try:
+                    new_raw = encode(decode(raw, old_codec), codec)
+                except _DECODE_ERRORS + (KeyError,):
+                    broken.append((key,))
+                    _count(endpoint, entries=-1, bytes=-len(raw))
+                    continue
+                updates.append((new_raw, len(new_raw), codec, key))
+                _count(endpoint, bytes=len(new_raw) - len(raw))
+            with db:
+                db.executemany("UPDATE cache SET data = ?, size = ?, codec = ? WHERE key = ?", updates)
+                db.executemany("DELETE FROM cache WHERE key = ?", broken)
+            for (key,) in broken:
+                _memory.discard(key)
+            recoded += len(updates)
+    return recoded
+
 
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "recode":
+        print(f"✅ Перекодировано записей кэша: {recode_cache()}")
+    else:
+        print("Использование: python cache.py recode")
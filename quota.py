@@ -0,0 +1,240 @@
+"""
+Общая квота запросов к OpenWeatherMap API с приоритетами
+
+Один API_KEY делят обработчики пользователей, inline-запросы и поток
+уведомлений. Перед каждым запросом к API (и каждым повтором) клиент берёт
+жетон из двух корзин (token bucket): API_QUOTA_PER_MINUTE запросов в минуту
+и API_QUOTA_PER_DAY в сутки.
+
+Приоритет запроса задаётся блоком with api_priority(...) и наследуется
+вызовами внутри него (contextvars):
+    INTERACTIVE - ответ пользователю в чате (по умолчанию),
+    INLINE      - inline-запросы,
+    BACKGROUND  - уведомления, фоновое обновление кэша, прогрев.
+Менее важный класс не может опустошить корзину ниже своего резерва
+(QUOTA_RESERVE - доля ёмкости, оставляемая более важным), поэтому при
+нехватке квоты фоновые запросы ждут или отбрасываются (QuotaExceeded),
+а запросы пользователей не получают 429.
+
+Уровень суточной корзины хранится в базе кэша (cache.get_quota_state):
+после перезапуска процесса корзина продолжает с сохранённого уровня,
+пополненного за время простоя, а не начинает полной. Уровень сохраняется
+не чаще раза в QUOTA_SAVE_INTERVAL секунд и при выходе, так что после
+аварийного завершения теряется не больше расхода за этот интервал.
+"""
+
+import os
+import time
+import atexit
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Iterator
+
+from cache import get_quota_state, set_quota_state
+
+API_QUOTA_PER_MINUTE = int(os.getenv("API_QUOTA_PER_MINUTE", "60"))
+API_QUOTA_PER_DAY = int(os.getenv("API_QUOTA_PER_DAY", "30000"))
+QUOTA_SAVE_INTERVAL = float(os.getenv("QUOTA_SAVE_INTERVAL", "5"))  # секунды
+
+# Классы приоритета: меньше - важнее
+INTERACTIVE = 0
+INLINE = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", INLINE: "inline", BACKGROUND: "background"}
+
+# Доля ёмкости каждой корзины, которую класс не трогает (резерв для более важных)
+QUOTA_RESERVE = {
+    INTERACTIVE: 0.0,
+    INLINE: 0.1,
+    BACKGROUND: 0.3,
+}
+
+# Сколько секунд класс может ждать жетон, прежде чем запрос будет отброшен.
+# Inline-запрос Telegram ждёт ответ недолго, уведомления могут подождать.
+QUOTA_MAX_WAIT = {
+    INTERACTIVE: 5.0,
+    INLINE: 2.0,
+    BACKGROUND: 60.0,
+}
+
+_priority: ContextVar[int] = ContextVar("api_priority", default=INTERACTIVE)
+
+
+class QuotaExceeded(Exception):
+    """Квота API исчерпана для класса приоритета: запрос отброшен без обращения к API"""
+
+    def __init__(self, priority: int, wait: float):
+        super().__init__(f"Квота API исчерпана ({PRIORITY_NAMES.get(priority, priority)}), "
+                         f"жетон через {wait:.1f} с")
+        self.priority = priority
+        self.wait = wait
+
+
+def current_priority() -> int:
+    """Приоритет запросов в текущем контексте"""
+    return _priority.get()
+
+
+@contextmanager
+def api_priority(priority: int) -> Iterator[None]:
+    """Задаёт приоритет запросов к API внутри блока with"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _TokenBucket:
+    """Корзина жетонов: capacity жетонов, пополняется rate жетонов в секунду"""
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, reserve: float) -> float:
+        """Секунды до момента, когда жетон можно взять, не трогая резерв (0 - уже можно)"""
+        needed = 1 + reserve * self.capacity - self.level
+        return max(0.0, needed / self.rate)
+
+
+class QuotaManager:
+    """
+    Корзины в минуту и в сутки и счётчики по классам приоритета
+
+    persistent=True - уровень суточной корзины загружается из базы кэша
+    при первом запросе и сохраняется в неё (см. описание модуля)
+    """
+
+    def __init__(self, per_minute: int = None, per_day: int = None, persistent: bool = False):
+        self._buckets = [
+            _TokenBucket(per_minute or API_QUOTA_PER_MINUTE, 60),
+            _TokenBucket(per_day or API_QUOTA_PER_DAY, 24 * 3600),
+        ]
+        self._lock = threading.Lock()
+        self._stats = {name: {"granted": 0, "waited": 0, "shed": 0} for name in PRIORITY_NAMES.values()}
+        self._persistent = persistent
+        self._loaded = not persistent
+        self._saved_at = None
+        if persistent:
+            atexit.register(self.save)
+
+    def _refill(self, now: float) -> None:
+        """Пополняет корзины; при первом вызове загружает сохранённую суточную (под _lock)"""
+        if not self._loaded:
+            self._loaded = True
+            state = get_quota_state("day")
+            if state is not None:
+                level, updated_at = state
+                day = self._buckets[1]
+                idle = max(0.0, time.time() - updated_at)
+                day.level = max(0.0, min(day.capacity, level + idle * day.rate))
+                day.updated = now
+        for bucket in self._buckets:
+            bucket.refill(now)
+
+    def _save(self, now: float) -> None:
+        """Сохраняет уровень суточной корзины, только что пополненной к now (под _lock)"""
+        self._saved_at = now
+        set_quota_state("day", self._buckets[1].level, time.time())
+
+    def save(self) -> None:
+        """Сохраняет уровень суточной корзины сразу (вызывается и при выходе)"""
+        with self._lock:
+            if self._persistent and self._loaded:
+                now = time.monotonic()
+                self._refill(now)
+                self._save(now)
+
+    def _try_take(self, priority: int) -> float:
+        """Берёт жетон, если класс может; иначе возвращает, сколько ждать"""
+        reserve = QUOTA_RESERVE.get(priority, 0.0)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(bucket.wait_for(reserve) for bucket in self._buckets)
+            if wait == 0:
+                for bucket in self._buckets:
+                    bucket.level -= 1
+                if self._persistent and (self._saved_at is None
+                                         or now - self._saved_at >= QUOTA_SAVE_INTERVAL):
+                    self._save(now)
+            return wait
+
+    def _count(self, priority: int, name: str) -> None:
+        with self._lock:
+            self._stats[PRIORITY_NAMES.get(priority, "background")][name] += 1
+
+    def _next_wait(self, priority: int, deadline: float, waited: bool) -> float:
+        """Один шаг acquire: 0 - жетон взят, иначе пауза; QuotaExceeded если ждать дольше срока"""
+        wait = self._try_take(priority)
+        if wait == 0:
+            self._count(priority, "granted")
+            return 0.0
+        if time.monotonic() + wait > deadline:
+            self._count(priority, "shed")
+            raise QuotaExceeded(priority, wait)
+        if not waited:
+            self._count(priority, "waited")
+        return wait
+
+    def acquire(self, priority: int = None) -> None:
+        """
+        Берёт жетон для запроса к API, при нехватке ждёт до QUOTA_MAX_WAIT класса
+
+        Raises:
+            QuotaExceeded: Жетон не появится в пределах ожидания - запрос отброшен
+        """
+        priority = current_priority() if priority is None else priority
+        deadline = time.monotonic() + QUOTA_MAX_WAIT.get(priority, 0.0)
+        waited = False
+        while True:
+            wait = self._next_wait(priority, deadline, waited)
+            if wait == 0:
+                return
+            waited = True
+            time.sleep(wait)
+
+    async def acquire_async(self, priority: int = None) -> None:
+        """acquire() для цикла событий: ждёт через asyncio.sleep, не блокируя цикл"""
+        priority = current_priority() if priority is None else priority
+        deadline = time.monotonic() + QUOTA_MAX_WAIT.get(priority, 0.0)
+        waited = False
+        while True:
+            wait = self._next_wait(priority, deadline, waited)
+            if wait == 0:
+                return
+            waited = True
+            await asyncio.sleep(wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Состояние квоты
+
+        Returns:
+            dict: {"minute": жетонов, "day": жетонов,
+                   "priorities": {класс: {granted, waited, shed}}}
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            minute, day = (int(bucket.level) for bucket in self._buckets)
+            return {
+                "minute": minute,
+                "day": day,
+                "priorities": {name: dict(counters) for name, counters in self._stats.items()}
+            }
+
+
+# Квота процесса: её делят все клиенты API, суточная корзина переживает перезапуск
+quota = QuotaManager(persistent=True)
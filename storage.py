@@ -1,33 +1,908 @@
 """
 Модуль для работы с данными пользователей
-Хранит настройки, локации и подписки в user_data.json
+Хранит настройки, локации и подписки в user_data.json или в SQLite (user_data.db)
+
+Бэкенд выбирается переменной окружения STORAGE_BACKEND: "json" (по умолчанию) или "sqlite"
+
+Пользователи загружаются в память один раз, чтения обслуживаются из памяти.
+Каждое изменение сразу дописывается одной строкой в журнал user_data.journal,
+а основное хранилище обновляется пачкой раз в USER_FLUSH_INTERVAL секунд
+и при завершении процесса, после чего журнал очищается (сворачивание в снимок).
+При запуске журнал проигрывается поверх снимка, так что падение процесса
+не теряет изменений. USER_JOURNAL_FSYNC=1 - fsync после каждой записи в журнал.
+
+Пользователей можно разбить на USER_SHARDS шардов по хэшу user_id: у каждого
+шарда свои файлы (user_data.0.json, user_data.0.journal, ... или user_data.0.db),
+своя блокировка и свой сброс на диск. Количество шардов сохраняется рядом
+с данными (user_data.shards) и дальше берётся оттуда: USER_SHARDS задаёт его
+только для новых данных. Перераспределение существующих данных:
+    python storage.py reshard <количество шардов>
 """
 
 import os
+import re
+import sys
 import json
-from typing import Optional, Dict, Any
+import copy
+import glob
+import time
+import zlib
+import atexit
+import itertools
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, Tuple, Set, List, Union
 
 USER_DATA_FILE = "user_data.json"
+USER_DB_FILE = "user_data.db"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+USER_JOURNAL_FILE = "user_data.journal"
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))  # секунды
+USER_JOURNAL_FSYNC = os.getenv("USER_JOURNAL_FSYNC", "0") == "1"
+USER_SCHEMA_FILE = "user_data.schema"
+USER_SHARDS = int(os.getenv("USER_SHARDS", "1"))
+USER_SHARDS_FILE = "user_data.shards"  # количество шардов, в которых лежат данные
+
+# Версия структуры данных пользователей:
+# 1 - location объект и поле subscribed, 2 - city/lat/lon и notifications объект
+SCHEMA_VERSION = 2
+USER_MIGRATION_CHUNK = 1000  # пользователей за один шаг фоновой миграции
+USER_MIGRATION_PAUSE = 0.05  # пауза между шагами, секунды
+
+# Каталог, в который reshard() пишет новые шарды до замены старых
+_RESHARD_DIR = ".reshard"
 
 
-def load_all_users() -> Dict[str, Any]:
-    """Загружает все данные пользователей из файла"""
-    if os.path.exists(USER_DATA_FILE):
+def load_all_users(path: str = None) -> Dict[str, Any]:
+    """Загружает все данные пользователей из файла (по умолчанию USER_DATA_FILE)"""
+    path = path or USER_DATA_FILE
+    if os.path.exists(path):
         try:
-            with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 return json.load(f)
         except json.JSONDecodeError:
             return {}
     return {}
 
 
-def save_all_users(data: Dict[str, Any]) -> None:
-    """Сохраняет все данные пользователей в файл"""
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
+def save_all_users(data: Dict[str, Any], path: str = None) -> None:
+    """
+    Сохраняет все данные пользователей в файл (по умолчанию USER_DATA_FILE)
+
+    Запись идёт во временный файл, который затем атомарно заменяет основной:
+    падение посреди записи не портит user_data.json.
+    """
+    path = path or USER_DATA_FILE
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonUserStore:
+    """Хранилище пользователей в одном JSON-файле (каждая операция читает весь файл)"""
+
+    # write_back переписывает файл целиком - ему нужна вся таблица шарда
+    write_back_full = True
+
+    def __init__(self, path: str = None, schema_path: str = None):
+        self.path = path or USER_DATA_FILE
+        self.schema_path = schema_path or USER_SCHEMA_FILE
+
+    def put_many(self, users: Dict[str, Dict[str, Any]]) -> None:
+        data = load_all_users(self.path)
+        data.update(users)
+        save_all_users(data, self.path)
+
+    def write_back(self, users: Dict[str, "UserRecord"], dirty: Set[str]) -> None:
+        # Таблица целиком в памяти - файл переписывается из неё без чтения
+        save_all_users({user_id: user.to_dict() for user_id, user in users.items()}, self.path)
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        return iter(load_all_users(self.path).items())
+
+    def get_schema_version(self) -> int:
+        try:
+            with open(self.schema_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 1
+
+    def set_schema_version(self, version: int) -> None:
+        with open(self.schema_path, "w", encoding="utf-8") as f:
+            f.write(str(version))
+
+    def close(self) -> None:
+        pass
+
+
+# ============== ШАРДЫ ==============
+
+def _shard_index(user_id_str: str, shards: int) -> int:
+    """Номер шарда пользователя (crc32 не зависит от запуска, в отличие от hash())"""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(user_id_str.encode()) % shards
+
+
+def _shard_path(path: str, index: int, shards: int) -> str:
+    """Путь к файлу шарда: user_data.json -> user_data.3.json (при одном шарде не меняется)"""
+    if shards <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+def _staged_path(path: str) -> str:
+    """Путь к файлу во временном каталоге reshard() рядом с исходным"""
+    return os.path.join(os.path.dirname(path), _RESHARD_DIR, os.path.basename(path))
+
+
+def _store_files(index: int, shards: int) -> List[str]:
+    """Файлы хранилища шарда выбранного бэкенда (без журнала)"""
+    if STORAGE_BACKEND == "sqlite":
+        return [_shard_path(USER_DB_FILE, index, shards)]
+    return [_shard_path(USER_DATA_FILE, index, shards), _shard_path(USER_SCHEMA_FILE, index, shards)]
+
+
+def _read_shard_count() -> Optional[int]:
+    """Количество шардов из USER_SHARDS_FILE или None, если файла нет"""
+    try:
+        with open(USER_SHARDS_FILE, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_shard_count(shards: int) -> None:
+    """Сохраняет количество шардов рядом с данными (атомарной заменой файла)"""
+    tmp_path = USER_SHARDS_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(str(shards))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, USER_SHARDS_FILE)
+
+
+def _layout_exists(shards: int) -> bool:
+    """Есть ли на диске файл хранилища хотя бы одного шарда раскладки"""
+    return any(os.path.exists(_store_files(index, shards)[0]) for index in range(shards))
+
+
+def _sharded_files() -> List[str]:
+    """Файлы хранилища шардов (user_data.<N>.json или .db) выбранного бэкенда"""
+    root, ext = os.path.splitext(_store_files(0, 1)[0])
+    pattern = re.compile(re.escape(root) + r"\.\d+" + re.escape(ext) + "$")
+    return sorted(path for path in glob.glob(f"{glob.escape(root)}.*{ext}") if pattern.match(path))
+
+
+def _data_shards() -> int:
+    """
+    Количество шардов, в которых лежат данные
+
+    Берётся из USER_SHARDS_FILE. Для данных, записанных до появления файла,
+    раскладка USER_SHARDS проверяется по файлам на диске: если её файлов нет,
+    а есть файлы другой раскладки, работа прекращается - иначе бот поднялся бы
+    с пустыми шардами, а reshard() затёр бы данные пустыми.
+
+    Raises:
+        RuntimeError: Данные лежат в другом количестве шардов, чем USER_SHARDS
+    """
+    saved = _read_shard_count()
+    if saved is not None:
+        if saved != USER_SHARDS and "USER_SHARDS" in os.environ:
+            print(f"⚠️ USER_SHARDS={USER_SHARDS} не совпадает с данными ({saved} шардов), "
+                  f"используется {saved}; изменить: python storage.py reshard <количество шардов>")
+        return saved
+
+    if not _layout_exists(USER_SHARDS):
+        # Файлов настроенной раскладки нет - значит, все найденные от другой
+        other = _sharded_files()
+        if USER_SHARDS > 1 and os.path.exists(_store_files(0, 1)[0]):
+            other.insert(0, _store_files(0, 1)[0])
+        if other:
+            raise RuntimeError(f"Данные пользователей разбиты на другое количество шардов "
+                               f"({', '.join(other)}), а USER_SHARDS={USER_SHARDS}: "
+                               f"задайте USER_SHARDS по этим файлам")
+    return USER_SHARDS
+
+
+def _open_store(index: int, shards: int, staged: bool = False):
+    """Открывает хранилище шарда выбранного бэкенда"""
+    paths = _store_files(index, shards)
+    if staged:
+        paths = [_staged_path(path) for path in paths]
+
+    if STORAGE_BACKEND == "sqlite":
+        from storage_sqlite import SqliteUserStore, import_from_json
+        db_path = paths[0]
+        if not staged and not os.path.exists(db_path):
+            # Первый запуск на SQLite - переносим данные шарда из JSON
+            import_from_json(USER_DATA_FILE, db_path,
+                             lambda user_id_str: _shard_index(user_id_str, shards) == index)
+        return SqliteUserStore(db_path)
+    return JsonUserStore(*paths)
+
+
+# ============== ЖУРНАЛ ИЗМЕНЕНИЙ ==============
+
+class _Journal:
+    """
+    Журнал изменений шарда - файл JSON Lines, одна строка {"id": ..., "user": {...}}
+    на изменение. При сворачивании текущий журнал переименовывается в .old: новые
+    записи идут в свежий файл, а .old удаляется только после успешной записи снимка.
+
+    Все методы вызываются под блокировкой шарда.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.old_path = path + ".old"
+        self._file = None
+
+    def append(self, user_id_str: str, user_data: Dict[str, Any]) -> None:
+        """Дописывает изменение в журнал"""
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        record = json.dumps({"id": user_id_str, "user": user_data}, ensure_ascii=False)
+        self._file.write(record + "\n")
+        self._file.flush()
+        if USER_JOURNAL_FSYNC:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """Закрывает файл журнала"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def rotate(self) -> None:
+        """Откладывает текущий журнал до записи снимка"""
+        self.close()
+        if not os.path.exists(self.path):
+            return
+
+        if not os.path.exists(self.old_path):
+            os.replace(self.path, self.old_path)
+            return
+
+        # Прошлый снимок не записался - копим изменения в том же .old
+        with open(self.path, "r", encoding="utf-8") as src, \
+                open(self.old_path, "a", encoding="utf-8") as dst:
+            dst.write(src.read())
+        os.remove(self.path)
+
+    def drop_old(self) -> None:
+        """Удаляет отложенный журнал после успешной записи снимка"""
+        try:
+            os.remove(self.old_path)
+        except OSError:
+            pass
+
+    def records(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Перебирает записи журнала (сначала отложенного, затем текущего)"""
+        for path in (self.old_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка после падения
+                        continue
+                    yield record["id"], record["user"]
+
+
+# ============== ЗАПИСЬ ПОЛЬЗОВАТЕЛЯ ==============
+
+# Раскладка битового поля настроек уведомлений UserRecord.flags:
+# бит 0 - enabled, биты 1-5 - start_hour, биты 6-10 - end_hour, с бита 11 - interval_h.
+# Целые Python не ограничены, поэтому interval_h - старшее поле без маски:
+# сохранённые данные с любым интервалом загружаются без потерь.
+_FLAG_ENABLED = 1
+_START_SHIFT = 1
+_END_SHIFT = 6
+_INTERVAL_SHIFT = 11
+_FIELD_MASK = 0x1F
+
+_DEFAULT_NOTIFICATIONS = {
+    "enabled": False,
+    "interval_h": 2,
+    "start_hour": 9,
+    "end_hour": 21
+}
+
+# Допустимые значения полей настроек: (минимум, максимум или None - без ограничения).
+# Одни и те же правила для новых значений (проверка) и сохранённых (приведение).
+_NOTIFICATION_LIMITS = {
+    "interval_h": (0, None),
+    "start_hour": (0, 23),
+    "end_hour": (0, 23),
+}
+
+
+def _check_flag_field(name: str, value: int) -> None:
+    """Проверяет новое значение поля настроек уведомлений"""
+    minimum, maximum = _NOTIFICATION_LIMITS[name]
+    if maximum is None:
+        if value < minimum:
+            raise ValueError(f"{name} меньше {minimum}: {value}")
+    elif not minimum <= value <= maximum:
+        raise ValueError(f"{name} вне диапазона {minimum}-{maximum}: {value}")
+
+
+def _pack_flags(enabled: bool, interval_h: int, start_hour: int, end_hour: int) -> int:
+    """Упаковывает настройки уведомлений в битовое поле"""
+    return ((_FLAG_ENABLED if enabled else 0)
+            | (interval_h << _INTERVAL_SHIFT)
+            | (start_hour << _START_SHIFT)
+            | (end_hour << _END_SHIFT))
 
 
-def load_user(user_id: int) -> dict:
+def _loaded_field(name: str, value: Any) -> int:
+    """Приводит сохранённое значение поля к целому в пределах _NOTIFICATION_LIMITS"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return _DEFAULT_NOTIFICATIONS[name]
+    minimum, maximum = _NOTIFICATION_LIMITS[name]
+    value = max(value, minimum)
+    return value if maximum is None else min(value, maximum)
+
+
+def _pack_loaded_flags(notifications: Mapping) -> int:
+    """
+    Упаковывает сохранённые настройки уведомлений без исключений: одна запись
+    с необычным значением не должна мешать загрузке всего шарда. Значения вне
+    _NOTIFICATION_LIMITS приводятся к границам (часы - к 0-23).
+    """
+    return _pack_flags(
+        bool(notifications["enabled"]),
+        _loaded_field("interval_h", notifications["interval_h"]),
+        _loaded_field("start_hour", notifications["start_hour"]),
+        _loaded_field("end_hour", notifications["end_hour"])
+    )
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    """Интернирует название города: у многих пользователей оно одинаковое"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserRecord(Mapping):
+    """
+    Компактная запись пользователя в памяти
+
+    Поля хранятся в __slots__, настройки уведомлений - в одном целом flags
+    вместо вложенного словаря. Для совместимости запись ведёт себя как
+    словарь старой формы только для чтения: user_data["lat"],
+    user_data.get("notifications", {}).get("enabled") и т.д.
+    """
+
+    __slots__ = ("city", "lat", "lon", "primary_city", "flags", "last_weather")
+
+    _KEYS = ("city", "lat", "lon", "primary_city", "notifications", "last_weather")
+
+    def __init__(self, city: str = None, lat: float = None, lon: float = None,
+                 primary_city: str = None, flags: int = None, last_weather: dict = None):
+        self.city = _intern(city)
+        self.lat = lat
+        self.lon = lon
+        self.primary_city = _intern(primary_city)
+        self.flags = flags if flags is not None else _pack_flags(**_DEFAULT_NOTIFICATIONS)
+        self.last_weather = last_weather
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.flags & _FLAG_ENABLED)
+
+    @property
+    def interval_h(self) -> int:
+        return self.flags >> _INTERVAL_SHIFT
+
+    @property
+    def start_hour(self) -> int:
+        return (self.flags >> _START_SHIFT) & _FIELD_MASK
+
+    @property
+    def end_hour(self) -> int:
+        return (self.flags >> _END_SHIFT) & _FIELD_MASK
+
+    @property
+    def notifications(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "interval_h": self.interval_h,
+            "start_hour": self.start_hour,
+            "end_hour": self.end_hour
+        }
+
+    def set_notifications(self, enabled: bool = None, interval_h: int = None,
+                          start_hour: int = None, end_hour: int = None) -> None:
+        """
+        Меняет настройки уведомлений (только у копии, не у записи из таблицы)
+
+        Переданные значения проверяются по _NOTIFICATION_LIMITS (часы 0-23,
+        интервал не меньше 0) - по тем же правилам, по которым приводятся
+        сохранённые данные при загрузке.
+        """
+        for name, value in (("interval_h", interval_h), ("start_hour", start_hour), ("end_hour", end_hour)):
+            if value is not None:
+                _check_flag_field(name, value)
+        self.flags = _pack_flags(
+            self.enabled if enabled is None else enabled,
+            self.interval_h if interval_h is None else interval_h,
+            self.start_hour if start_hour is None else start_hour,
+            self.end_hour if end_hour is None else end_hour
+        )
+
+    def copy(self) -> "UserRecord":
+        return UserRecord(self.city, self.lat, self.lon, self.primary_city,
+                          self.flags, self.last_weather)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Сериализует запись в JSON-форму user_data.json"""
+        return {
+            "city": self.city,
+            "lat": self.lat,
+            "lon": self.lon,
+            "primary_city": self.primary_city,
+            "notifications": self.notifications,
+            "last_weather": self.last_weather
+        }
+
+    @classmethod
+    def from_dict(cls, user_data: Mapping) -> "UserRecord":
+        """Создаёт запись из JSON-формы (недостающие поля - по умолчанию)"""
+        notifications = dict(_DEFAULT_NOTIFICATIONS)
+        notifications.update(user_data.get("notifications") or {})
+        return cls(
+            city=user_data.get("city"),
+            lat=user_data.get("lat"),
+            lon=user_data.get("lon"),
+            primary_city=user_data.get("primary_city"),
+            flags=_pack_loaded_flags(notifications),
+            last_weather=copy.deepcopy(user_data.get("last_weather"))
+        )
+
+    # Интерфейс словаря только для чтения (совместимость с bot_v2.py)
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return len(self._KEYS)
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r})"
+
+
+def _as_record(value: Union[UserRecord, Dict[str, Any]]) -> UserRecord:
+    """Возвращает запись; словарь старой структуры обновляется по копии"""
+    if isinstance(value, UserRecord):
+        return value
+    user_data = copy.deepcopy(value)
+    _upgrade_user_data(user_data)
+    return UserRecord.from_dict(user_data)
+
+
+class _UsersView(Mapping):
+    """
+    Снимок таблиц шардов только для чтения (список по номеру шарда);
+    необновлённые словари отдаются записями
+    """
+
+    __slots__ = ("_tables",)
+
+    def __init__(self, tables: List[Dict[str, Union[UserRecord, Dict[str, Any]]]]):
+        self._tables = tables
+
+    def __getitem__(self, user_id_str: str) -> UserRecord:
+        if not isinstance(user_id_str, str):
+            raise KeyError(user_id_str)
+        table = self._tables[_shard_index(user_id_str, len(self._tables))]
+        return _as_record(table[user_id_str])
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._tables)
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self._tables)
+
+
+def _upgrade_user_data(user_data: Dict[str, Any]) -> bool:
+    """
+    Приводит словарь пользователя старой структуры к текущей (на месте)
+
+    Returns:
+        bool: True если структура была устаревшей
+    """
+    needs_migration = False
+
+    # Миграция старой структуры location
+    if "location" in user_data:
+        location = user_data.pop("location")
+        user_data["city"] = location.get("name")
+        user_data["lat"] = location.get("lat")
+        user_data["lon"] = location.get("lon")
+        needs_migration = True
+
+    # Миграция старого поля subscribed
+    if "subscribed" in user_data:
+        subscribed = user_data.pop("subscribed")
+        if "notifications" not in user_data:
+            user_data["notifications"] = {
+                "enabled": subscribed,
+                "interval_h": 2,
+                "start_hour": 9,
+                "end_hour": 21
+            }
+        needs_migration = True
+
+    # Добавление новых полей если их нет
+    if "primary_city" not in user_data:
+        user_data["primary_city"] = None
+        needs_migration = True
+
+    if "notifications" not in user_data:
+        user_data["notifications"] = {
+            "enabled": False,
+            "interval_h": 2,
+            "start_hour": 9,
+            "end_hour": 21
+        }
+        needs_migration = True
+    else:
+        # Обновление существующего notifications объекта
+        notifications = user_data["notifications"]
+        if "start_hour" not in notifications:
+            notifications["start_hour"] = 9
+            needs_migration = True
+        if "end_hour" not in notifications:
+            notifications["end_hour"] = 21
+            needs_migration = True
+
+    return needs_migration
+
+
+# ============== ТАБЛИЦА ПОЛЬЗОВАТЕЛЕЙ В ПАМЯТИ ==============
+
+# Записи в таблице не изменяются на месте: обновление кладёт новую запись.
+# Сама таблица копируется при записи (copy-on-write): снимок отдаёт текущий
+# словарь как есть и помечает его общим, а первая следующая запись работает
+# уже с копией. Снимок бесплатен для читателя и не блокирует писателей.
+#
+# Если данные на диске старой версии схемы, при загрузке записи не разбираются:
+# в таблице лежат исходные словари, которые обновляются при первом чтении
+# (load_user) или фоновой миграцией по частям (migrate_user_data).
+class _Shard:
+    """
+    Шард пользователей: хранилище, журнал, таблица в памяти и индекс по часам
+
+    Всё состояние шарда защищено его собственной блокировкой lock, сброс
+    на диск - flush_lock; записи в разные шарды друг друга не ждут.
+    """
+
+    def __init__(self, index: int, shards: int):
+        self.index = index
+        self.store = _open_store(index, shards)
+        self.journal = _Journal(_shard_path(USER_JOURNAL_FILE, index, shards))
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.users: Optional[Dict[str, Union[UserRecord, Dict[str, Any]]]] = None
+        self.snapshot_shared = False
+        self.schema_current = False
+        self.dirty: Set[str] = set()
+        # Индекс подписчиков по часу суток: hour_index[hour] - ID пользователей,
+        # у которых уведомления включены и период уведомлений охватывает этот час.
+        # Строится при первом запросе и дальше поддерживается при каждой записи.
+        self.hour_index: Optional[List[Set[str]]] = None
+
+    def table(self) -> Dict[str, Union[UserRecord, Dict[str, Any]]]:
+        """Возвращает таблицу шарда, при первом обращении загружает её с диска"""
+        if self.users is None:
+            with self.lock:
+                if self.users is None:
+                    table = {}
+                    if self.store.get_schema_version() >= SCHEMA_VERSION:
+                        for user_id_str, user_data in self.store.items():
+                            table[user_id_str] = UserRecord.from_dict(user_data)
+                    else:
+                        table.update(self.store.items())
+
+                    # Журнал всегда пишется записями текущей структуры
+                    for user_id_str, user_data in self.journal.records():
+                        table[user_id_str] = UserRecord.from_dict(user_data)
+                        self.dirty.add(user_id_str)
+
+                    self.schema_current = all(isinstance(user, UserRecord) for user in table.values())
+                    if self.schema_current and self.store.get_schema_version() < SCHEMA_VERSION:
+                        # Пустое хранилище или журнал покрыл всех - обновлять нечего
+                        self.store.set_schema_version(SCHEMA_VERSION)
+                    self.users = table
+        return self.users
+
+    def writable_table(self) -> Dict[str, Union[UserRecord, Dict[str, Any]]]:
+        """Возвращает таблицу для записи, копируя её если она отдана снимку (под lock)"""
+        table = self.table()
+        if self.snapshot_shared:
+            table = self.users = dict(table)
+            self.snapshot_shared = False
+        return table
+
+    def snapshot(self) -> Dict[str, Union[UserRecord, Dict[str, Any]]]:
+        """Отдаёт текущую таблицу снимку без копирования"""
+        self.table()
+        with self.lock:
+            self.snapshot_shared = True
+            return self.users
+
+    def index_replace(self, user_id_str: str, old: Optional[UserRecord], new: Optional[UserRecord]) -> None:
+        """Переносит пользователя в индексе по часам (вызывается под lock)"""
+        if self.hour_index is None:
+            return
+        if old is not None:
+            old = _as_record(old)
+        if old is not None and old.enabled:
+            for hour in notification_hours(old.notifications):
+                self.hour_index[hour].discard(user_id_str)
+        if new is not None and new.enabled:
+            for hour in notification_hours(new.notifications):
+                self.hour_index[hour].add(user_id_str)
+
+    def get_hour_index(self) -> List[Set[str]]:
+        """Возвращает индекс подписчиков по часам, при первом обращении строит его"""
+        if self.hour_index is None:
+            with self.lock:
+                if self.hour_index is None:
+                    index = [set() for _ in range(24)]
+                    for user_id_str, user in _UsersView([self.table()]).items():
+                        if user.enabled:
+                            for hour in notification_hours(user.notifications):
+                                index[hour].add(user_id_str)
+                    self.hour_index = index
+        return self.hour_index
+
+    def upgrade(self, user_id_str: str) -> UserRecord:
+        """Заменяет в таблице словарь старой структуры на обновлённую запись"""
+        with self.lock:
+            table = self.writable_table()
+            user = table[user_id_str]
+            if not isinstance(user, UserRecord):
+                user = _as_record(user)
+                table[user_id_str] = user
+                self.dirty.add(user_id_str)
+        return user
+
+    def flush(self) -> int:
+        """
+        Записывает изменённых пользователей шарда в хранилище одной пачкой
+        и очищает журнал шарда (сворачивание журнала в снимок)
+
+        Returns:
+            int: Количество сброшенных пользователей
+        """
+        with self.flush_lock:
+            with self.lock:
+                if self.users is None or not self.dirty:
+                    return 0
+                dirty = set(self.dirty)
+                self.dirty.clear()
+                if self.store.write_back_full:
+                    snapshot = _UsersView([self.snapshot()])
+                else:
+                    # Хранилищу нужны только изменённые строки: снимок всей
+                    # таблицы заставил бы следующую запись копировать её целиком
+                    snapshot = _UsersView([{user_id_str: self.users[user_id_str]
+                                            for user_id_str in dirty if user_id_str in self.users}])
+                self.journal.rotate()
+
+            try:
+                self.store.write_back(snapshot, dirty)
+            except Exception:
+                # Не удалось записать - вернём пометки, попробуем в следующий раз;
+                # отложенный журнал остаётся на диске до успешной записи
+                with self.lock:
+                    self.dirty.update(dirty)
+                raise
+
+            self.journal.drop_old()
+
+        return len(dirty)
+
+    def close(self) -> None:
+        """Закрывает журнал и хранилище шарда (после flush)"""
+        with self.lock:
+            self.journal.close()
+            self.store.close()
+
+
+_shards: Optional[List[_Shard]] = None
+_shards_lock = threading.Lock()
+_flush_thread: Optional[threading.Thread] = None
+
+# Блокировки пользователей для read-modify-write в user_session.
+# Отдельный Lock на каждого из миллиона пользователей дорог, поэтому
+# пользователи распределяются по фиксированному набору блокировок по хэшу ID.
+# RLock: вложенный user_session другого пользователя с той же блокировкой
+# в том же потоке не зависает.
+_USER_LOCK_STRIPES = 1024
+_user_locks = [threading.RLock() for _ in range(_USER_LOCK_STRIPES)]
+
+
+def _user_lock(user_id_str: str) -> threading.RLock:
+    """Возвращает блокировку пользователя"""
+    return _user_locks[hash(user_id_str) % _USER_LOCK_STRIPES]
+
+
+def _get_shards() -> List[_Shard]:
+    """
+    Возвращает шарды пользователей, при первом обращении открывает их
+    (в количестве, в котором лежат данные, см. _data_shards)
+    """
+    global _shards, USER_SHARDS
+    if _shards is None:
+        with _shards_lock:
+            if _shards is None:
+                shards = _data_shards()
+                if _read_shard_count() != shards:
+                    _write_shard_count(shards)
+                USER_SHARDS = shards
+                _shards = [_Shard(index, shards) for index in range(shards)]
+    return _shards
+
+
+def _shard_for(user_id_str: str) -> _Shard:
+    """Возвращает шард пользователя"""
+    shards = _get_shards()
+    return shards[_shard_index(user_id_str, len(shards))]
+
+
+def reset_store() -> None:
+    """
+    Сбрасывает изменения на диск и закрывает хранилища всех шардов;
+    следующее обращение откроет их заново
+    """
+    global _shards
+    flush_users()
+    with _shards_lock:
+        shards, _shards = _shards, None
+    for shard in shards or ():
+        shard.close()
+
+
+def users_snapshot() -> Mapping:
+    """
+    Возвращает снимок всех пользователей только для чтения
+
+    Снимок не копирует таблицы и не держит блокировок, его можно перебирать
+    сколько угодно долго: изменения после вызова в него не попадут.
+    Снимки шардов берутся по очереди, каждый из них согласован.
+
+    Returns:
+        Mapping: {user_id_str: UserRecord}
+    """
+    return _UsersView([shard.snapshot() for shard in _get_shards()])
+
+
+def _put_user(user_id_str: str, user: UserRecord, if_missing: bool = False) -> UserRecord:
+    """
+    Кладёт запись в таблицу шарда, пишет её в журнал и помечает для записи в снимок
+
+    Args:
+        if_missing: Записать только если пользователя ещё нет
+
+    Returns:
+        UserRecord: Запись, которая оказалась в таблице
+    """
+    shard = _shard_for(user_id_str)
+    with shard.lock:
+        table = shard.writable_table()
+        current = table.get(user_id_str)
+        if if_missing and current is not None:
+            return _as_record(current)
+        # Индекс обновляется до журнала: если запись в журнал не удалась,
+        # индекс возвращается к прежней записи, а таблица остаётся без изменений
+        shard.index_replace(user_id_str, current, user)
+        try:
+            shard.journal.append(user_id_str, user.to_dict())
+        except BaseException:
+            shard.index_replace(user_id_str, user, current)
+            raise
+        table[user_id_str] = user
+        shard.dirty.add(user_id_str)
+
+    if USER_FLUSH_INTERVAL <= 0:
+        shard.flush()
+    else:
+        _ensure_flusher()
+    return user
+
+
+def flush_users() -> int:
+    """
+    Записывает изменённых пользователей в хранилище (каждый шард своей пачкой)
+    и очищает журналы (сворачивание журнала в снимок)
+
+    Returns:
+        int: Количество сброшенных пользователей
+    """
+    shards = _shards
+    if shards is None:
+        return 0
+
+    flushed = 0
+    error = None
+    for shard in shards:
+        try:
+            flushed += shard.flush()
+        except Exception as e:
+            # Ошибка одного шарда не мешает сбросить остальные
+            error = error or e
+    if error is not None:
+        raise error
+    return flushed
+
+
+def _flush_loop() -> None:
+    """Фоновый поток: сворачивает журналы в снимок раз в USER_FLUSH_INTERVAL секунд"""
+    while True:
+        time.sleep(USER_FLUSH_INTERVAL)
+        try:
+            flush_users()
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить данные пользователей: {e}")
+
+
+def _ensure_flusher() -> None:
+    """Запускает фоновый поток сворачивания при первой записи"""
+    global _flush_thread
+    if _flush_thread is not None:
+        return
+    with _shards_lock:
+        if _flush_thread is None:
+            _flush_thread = threading.Thread(target=_flush_loop, daemon=True)
+            _flush_thread.start()
+
+
+atexit.register(flush_users)
+
+
+def notification_hours(notifications: Dict[str, Any]) -> List[int]:
+    """
+    Возвращает часы суток, в которые пользователю можно слать уведомления
+
+    Args:
+        notifications: Настройки уведомлений пользователя
+
+    Returns:
+        list: Часы 0-23; пустой список если уведомления выключены.
+        Часы периода за пределами суток (сохранённые end_hour 24 и больше)
+        отбрасываются, как и при сравнении start_hour <= hour < end_hour
+    """
+    if not notifications.get("enabled", False):
+        return []
+
+    start_hour = notifications.get("start_hour", 9)
+    end_hour = notifications.get("end_hour", 21)
+
+    if start_hour <= end_hour:
+        hours = range(start_hour, end_hour)
+    else:
+        # Период переходит через полночь (например, 22:00 - 06:00)
+        hours = itertools.chain(range(start_hour, 24), range(0, end_hour))
+    return [hour for hour in hours if 0 <= hour < 24]
+
+
+def load_user(user_id: int) -> UserRecord:
     """
     Загружает данные конкретного пользователя
     
@@ -35,7 +910,7 @@ def load_user(user_id: int) -> dict:
         user_id: ID пользователя Telegram
         
     Returns:
-        dict: Данные пользователя со структурой:
+        UserRecord: Данные пользователя; читаются как словарь со структурой:
         {
             "city": str | None,
             "lat": float | None,
@@ -49,30 +924,22 @@ def load_user(user_id: int) -> dict:
             },
             "last_weather": dict | None
         }
+
+        Возвращается запись из памяти: не изменяйте её на месте,
+        для изменений используйте save_user и update_user_*.
     """
-    data = load_all_users()
     user_id_str = str(user_id)
-    
-    if user_id_str not in data:
+    shard = _shard_for(user_id_str)
+    user = shard.table().get(user_id_str)
+
+    if user is None:
         # Создаем нового пользователя с дефолтными настройками
-        default_user = {
-            "city": None,
-            "lat": None,
-            "lon": None,
-            "primary_city": None,
-            "notifications": {
-                "enabled": False,
-                "interval_h": 2,
-                "start_hour": 9,
-                "end_hour": 21
-            },
-            "last_weather": None
-        }
-        data[user_id_str] = default_user
-        save_all_users(data)
-        return default_user
-    
-    return data[user_id_str]
+        user = _put_user(user_id_str, UserRecord(), if_missing=True)
+    elif not isinstance(user, UserRecord):
+        # Запись старой структуры - обновляем при первом чтении
+        user = shard.upgrade(user_id_str)
+
+    return user
 
 
 def save_user(user_id: int, user_data: dict) -> None:
@@ -81,11 +948,40 @@ def save_user(user_id: int, user_data: dict) -> None:
     
     Args:
         user_id: ID пользователя Telegram
-        user_data: Словарь с данными пользователя
+        user_data: Словарь с данными пользователя (или UserRecord)
+    """
+    _put_user(str(user_id), UserRecord.from_dict(user_data))
+
+
+@contextmanager
+def user_session(user_id: int) -> Iterator[UserRecord]:
     """
-    data = load_all_users()
-    data[str(user_id)] = user_data
-    save_all_users(data)
+    Изменение пользователя одной транзакцией
+
+    Пользователь загружается один раз, внутри блока можно менять любые поля,
+    а при выходе изменения записываются одной записью в журнал. Блок выполняется
+    под блокировкой пользователя; при исключении изменения отбрасываются.
+
+        with user_session(user_id) as user:
+            user.city, user.lat, user.lon = city, lat, lon
+            user.set_notifications(enabled=True)
+
+    Args:
+        user_id: ID пользователя Telegram
+
+    Yields:
+        UserRecord: Копия записи пользователя для изменения
+    """
+    user_id_str = str(user_id)
+    with _user_lock(user_id_str):
+        current = load_user(user_id)
+        user = current.copy()
+        yield user
+
+        if user != current:
+            user.city = _intern(user.city)
+            user.primary_city = _intern(user.primary_city)
+            _put_user(user_id_str, user)
 
 
 def update_user_location(user_id: int, city: str = None, lat: float = None, lon: float = None) -> None:
@@ -98,16 +994,13 @@ def update_user_location(user_id: int, city: str = None, lat: float = None, lon:
         lat: Широта (опционально)
         lon: Долгота (опционально)
     """
-    user_data = load_user(user_id)
-    
-    if city:
-        user_data["city"] = city
-    if lat is not None:
-        user_data["lat"] = lat
-    if lon is not None:
-        user_data["lon"] = lon
-    
-    save_user(user_id, user_data)
+    with user_session(user_id) as user:
+        if city:
+            user.city = city
+        if lat is not None:
+            user.lat = lat
+        if lon is not None:
+            user.lon = lon
 
 
 def update_user_notifications(user_id: int, enabled: bool = None, interval_h: int = None, start_hour: int = None, end_hour: int = None) -> None:
@@ -121,18 +1014,9 @@ def update_user_notifications(user_id: int, enabled: bool = None, interval_h: in
         start_hour: Начало периода уведомлений (часы, 0-23, опционально)
         end_hour: Конец периода уведомлений (часы, 0-23, опционально)
     """
-    user_data = load_user(user_id)
-
-    if enabled is not None:
-        user_data["notifications"]["enabled"] = enabled
-    if interval_h is not None:
-        user_data["notifications"]["interval_h"] = interval_h
-    if start_hour is not None:
-        user_data["notifications"]["start_hour"] = start_hour
-    if end_hour is not None:
-        user_data["notifications"]["end_hour"] = end_hour
-
-    save_user(user_id, user_data)
+    with user_session(user_id) as user:
+        user.set_notifications(enabled=enabled, interval_h=interval_h,
+                               start_hour=start_hour, end_hour=end_hour)
 
 
 def update_user_primary_city(user_id: int, primary_city: str = None) -> None:
@@ -143,9 +1027,8 @@ def update_user_primary_city(user_id: int, primary_city: str = None) -> None:
         user_id: ID пользователя
         primary_city: Основной город для быстрого доступа (опционально)
     """
-    user_data = load_user(user_id)
-    user_data["primary_city"] = primary_city
-    save_user(user_id, user_data)
+    with user_session(user_id) as user:
+        user.primary_city = primary_city
 
 
 def has_location(user_id: int) -> bool:
@@ -158,88 +1041,153 @@ def has_location(user_id: int) -> bool:
     Returns:
         bool: True если есть координаты или город
     """
-    user_data = load_user(user_id)
-    return (user_data.get("lat") is not None and user_data.get("lon") is not None) or user_data.get("city") is not None
+    user = load_user(user_id)
+    return (user.lat is not None and user.lon is not None) or user.city is not None
 
 
-def get_subscribed_users() -> Dict[int, dict]:
+def get_subscribed_users(hour: int = None) -> Dict[int, UserRecord]:
     """
     Возвращает всех пользователей с включенными уведомлениями
 
+    Args:
+        hour: Час суток (0-23). Если указан, возвращаются только подписчики,
+              у которых период уведомлений охватывает этот час (по индексу,
+              без перебора всех пользователей)
+
     Returns:
         dict: Словарь {user_id: user_data} для подписанных пользователей
     """
-    data = load_all_users()
     subscribed = {}
 
-    for user_id_str, user_data in data.items():
-        if user_data.get("notifications", {}).get("enabled", False):
-            subscribed[int(user_id_str)] = user_data
+    if hour is not None:
+        for shard in _get_shards():
+            index = shard.get_hour_index()
+            with shard.lock:
+                table = shard.table()
+                for user_id_str in index[hour]:
+                    subscribed[int(user_id_str)] = _as_record(table[user_id_str])
+        return subscribed
+
+    for user_id_str, user in users_snapshot().items():
+        if user.enabled:
+            subscribed[int(user_id_str)] = user
 
     return subscribed
 
 
-def migrate_user_data() -> None:
+def _migrate_in_chunks() -> None:
+    """Обновляет все записи старой структуры по USER_MIGRATION_CHUNK за шаг, шард за шардом"""
+    for shard in _get_shards():
+        if shard.schema_current:
+            continue
+        user_ids = list(shard.snapshot())
+
+        for start in range(0, len(user_ids), USER_MIGRATION_CHUNK):
+            with shard.lock:
+                table = shard.table()
+                for user_id_str in user_ids[start:start + USER_MIGRATION_CHUNK]:
+                    user = table.get(user_id_str)
+                    if user is not None and not isinstance(user, UserRecord):
+                        shard.upgrade(user_id_str)
+            # Отпускаем блокировку, чтобы обработчики не ждали всю миграцию
+            time.sleep(USER_MIGRATION_PAUSE)
+
+        # Версия схемы записывается только после того, как обновлённые записи на диске
+        shard.flush()
+        shard.store.set_schema_version(SCHEMA_VERSION)
+        shard.schema_current = True
+    print("✅ Миграция данных пользователей выполнена")
+
+
+def migrate_user_data(background: bool = False) -> None:
     """
     Миграция данных пользователей к новой структуре.
     Обновляет старую структуру (location объект, subscribed поле)
     на новую структуру (отдельные поля city/lat/lon, notifications объект).
+
+    Если хранилище уже помечено текущей версией схемы (SCHEMA_VERSION),
+    ничего не делает. Иначе записи обновляются по частям; до окончания
+    миграции каждая запись всё равно обновляется при первом чтении.
+
+    Args:
+        background: Выполнять миграцию в фоновом потоке, не задерживая запуск
     """
-    data = load_all_users()
-    migrated = False
+    shards = _get_shards()
+    for shard in shards:
+        shard.table()
+    if all(shard.schema_current for shard in shards):
+        print("ℹ️ Миграция не требуется - данные уже в актуальном формате")
+        return
 
-    for user_id_str, user_data in data.items():
-        needs_migration = False
+    if background:
+        threading.Thread(target=_migrate_in_chunks, daemon=True).start()
+    else:
+        _migrate_in_chunks()
 
-        # Миграция старой структуры location
-        if "location" in user_data:
-            location = user_data.pop("location")
-            user_data["city"] = location.get("name")
-            user_data["lat"] = location.get("lat")
-            user_data["lon"] = location.get("lon")
-            needs_migration = True
 
-        # Миграция старого поля subscribed
-        if "subscribed" in user_data:
-            subscribed = user_data.pop("subscribed")
-            if "notifications" not in user_data:
-                user_data["notifications"] = {
-                    "enabled": subscribed,
-                    "interval_h": 2,
-                    "start_hour": 9,
-                    "end_hour": 21
-                }
-            needs_migration = True
+def reshard(shards: int) -> int:
+    """
+    Перераспределяет существующих пользователей по новому количеству шардов
 
-        # Добавление новых полей если их нет
-        if "primary_city" not in user_data:
-            user_data["primary_city"] = None
-            needs_migration = True
+    Запускается при остановленном боте. Текущее количество шардов берётся из
+    USER_SHARDS_FILE (см. _data_shards). Новые шарды сначала полностью пишутся
+    во временный каталог .reshard и только потом заменяют файлы старых шардов,
+    после чего в USER_SHARDS_FILE записывается новое количество.
 
-        if "notifications" not in user_data:
-            user_data["notifications"] = {
-                "enabled": False,
-                "interval_h": 2,
-                "start_hour": 9,
-                "end_hour": 21
-            }
-            needs_migration = True
-        else:
-            # Обновление существующего notifications объекта
-            notifications = user_data["notifications"]
-            if "start_hour" not in notifications:
-                notifications["start_hour"] = 9
-                needs_migration = True
-            if "end_hour" not in notifications:
-                notifications["end_hour"] = 21
-                needs_migration = True
-
-        if needs_migration:
-            migrated = True
-
-    if migrated:
-        save_all_users(data)
-        print("✅ Миграция данных пользователей выполнена")
-    else:
-        print("ℹ️ Миграция не требуется - данные уже в актуальном формате")
+    Args:
+        shards: Новое количество шардов
+
+    Returns:
+        int: Количество перенесённых пользователей
+    """
+    global USER_SHARDS
+    if shards < 1:
+        raise ValueError(f"Количество шардов должно быть положительным: {shards}")
+
+    # Снимок уже включает проигранные журналы и обновлённые записи
+    users = users_snapshot()
+    parts = [{} for _ in range(shards)]
+    for user_id_str, user in users.items():
+        parts[_shard_index(user_id_str, shards)][user_id_str] = user
 
+    for index, part in enumerate(parts):
+        for path in _store_files(index, shards):
+            os.makedirs(os.path.dirname(_staged_path(path)), exist_ok=True)
+        store = _open_store(index, shards, staged=True)
+        try:
+            store.write_back(part, set(part))
+            store.set_schema_version(SCHEMA_VERSION)
+        finally:
+            store.close()
+
+    # Старые шарды: журналы свёрнуты при сбросе, файлы больше не нужны
+    reset_store()
+    for index in range(USER_SHARDS):
+        journal = _shard_path(USER_JOURNAL_FILE, index, USER_SHARDS)
+        for path in _store_files(index, USER_SHARDS) + [journal, journal + ".old"]:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+
+    for index in range(shards):
+        for path in _store_files(index, shards):
+            os.replace(_staged_path(path), path)
+    for path in _store_files(0, shards):
+        try:
+            os.rmdir(os.path.dirname(_staged_path(path)))
+        except OSError:
+            pass
+
+    _write_shard_count(shards)
+    USER_SHARDS = shards
+    return len(users)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "reshard":
+        moved = reshard(int(sys.argv[2]))
+        print(f"✅ Перераспределено пользователей: {moved} по {USER_SHARDS} шардам")
+    else:
+        print("Использование: python storage.py reshard <количество шардов>")
@@ -0,0 +1,138 @@
+"""
+SQLite-бэкенд для хранилища пользователей
+Каждый пользователь хранится отдельной строкой, чтение и запись идут построчно
+
+Разовый импорт из user_data.json:
+    python storage_sqlite.py user_data.json user_data.db
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+from typing import Dict, Any, Iterator, Tuple, Set, Callable
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+
+def _upgrade_schema(conn: sqlite3.Connection) -> None:
+    """
+    Убирает колонку флага подписки и её индекс из базы, созданной до индекса
+    по часам в памяти (storage.py): их больше никто не читает
+    """
+    conn.execute("DROP INDEX IF EXISTS idx_users_notifications_enabled")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if "notifications_enabled" in columns:
+        try:
+            conn.execute("ALTER TABLE users DROP COLUMN notifications_enabled")
+        except sqlite3.OperationalError:
+            # SQLite до 3.35 не умеет удалять колонки - у неё есть значение
+            # по умолчанию, так что новые строки пишутся и без неё
+            pass
+
+
+class SqliteUserStore:
+    """
+    Хранилище пользователей в SQLite
+
+    Одно соединение на процесс, доступ к нему сериализован блокировкой:
+    telebot вызывает обработчики из разных потоков.
+    """
+
+    # write_back пишет только изменённые строки - вся таблица шарда не нужна
+    write_back_full = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        _upgrade_schema(self._conn)
+        self._conn.commit()
+
+    def put_many(self, users: Dict[str, Dict[str, Any]]) -> None:
+        """Записывает пачку пользователей одной транзакцией"""
+        rows = [
+            (user_id, json.dumps(user_data, ensure_ascii=False))
+            for user_id, user_data in users.items()
+        ]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                    rows
+                )
+
+    def write_back(self, users: Dict[str, Any], dirty: Set[str]) -> None:
+        """Записывает только изменённых пользователей из таблицы в памяти (UserRecord)"""
+        self.put_many({user_id: users[user_id].to_dict() for user_id in dirty if user_id in users})
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Перебирает всех пользователей"""
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        for user_id, data in rows:
+            yield user_id, json.loads(data)
+
+    def get_schema_version(self) -> int:
+        """Возвращает версию структуры данных (PRAGMA user_version, 0 - не задана)"""
+        with self._lock:
+            return self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def set_schema_version(self, version: int) -> None:
+        """Помечает базу версией структуры данных"""
+        with self._lock:
+            self._conn.execute(f"PRAGMA user_version = {int(version)}")
+            self._conn.commit()
+
+    def close(self) -> None:
+        """Закрывает соединение"""
+        with self._lock:
+            self._conn.close()
+
+
+def import_from_json(json_path: str, db_path: str,
+                     user_filter: Callable[[str], bool] = None) -> int:
+    """
+    Разовый импорт пользователей из JSON-файла в SQLite
+
+    Args:
+        json_path: Путь к user_data.json
+        db_path: Путь к базе SQLite (создаётся если её нет)
+        user_filter: Импортировать только пользователей, для ID которых
+                     функция вернёт True (например, пользователей одного шарда)
+
+    Returns:
+        int: Количество импортированных пользователей
+    """
+    if not os.path.exists(json_path):
+        return 0
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    if user_filter is not None:
+        data = {user_id: user_data for user_id, user_data in data.items() if user_filter(user_id)}
+
+    store = SqliteUserStore(db_path)
+    try:
+        store.put_many(data)
+    finally:
+        store.close()
+    return len(data)
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else "user_data.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else "user_data.db"
+    imported = import_from_json(source, target)
+    print(f"✅ Импортировано пользователей: {imported} ({source} → {target})")
@@ -1,12 +1,150 @@
 from ast import main
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import os
 import json
+import time
+import random
+
+from quota import quota, QuotaExceeded
+from breaker import get_breaker, is_failure_status, CircuitOpen
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
 
+# Таймауты запросов по endpoint, секунды: (соединение, чтение).
+# Без таймаута зависший сокет навсегда занимает поток обработчика telebot.
+API_TIMEOUTS = {
+    "weather": (3.05, 10),
+    "forecast": (3.05, 15),
+    "air_pollution": (3.05, 10),
+    "geo": (3.05, 10),
+}
+API_DEFAULT_TIMEOUT = (3.05, 10)
+
+# Повторы при 429, 5xx и ошибках соединения: не больше API_RETRIES повторов,
+# пауза - случайная в пределах API_BACKOFF * 2^попытка (но не больше
+# API_BACKOFF_MAX), чтобы потоки после сбоя не повторяли запросы одновременно
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))
+API_BACKOFF = 0.5
+API_BACKOFF_MAX = 5.0
+API_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Размер пула соединений: сколько потоков одновременно держат keep-alive
+# соединение с api.openweathermap.org
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))
+
+
+def _create_session() -> requests.Session:
+    """Создаёт сессию с пулом keep-alive соединений (повторы - в _request)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=API_POOL_SIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Одна сессия на процесс: пул urllib3 потокобезопасен, а cookies и
+# авторизация сессии не используются, поэтому её делят все потоки бота
+_session = _create_session()
+
+
+class ApiError(Exception):
+    """Ошибка ответа OpenWeatherMap: status - код HTTP-ответа (404 - не найдено)"""
+
+    def __init__(self, status: int, message: str = None):
+        super().__init__(message or f"Ошибка: {status}")
+        self.status = status
+
+
+def backoff_delay(attempt: int, response=None) -> float:
+    """
+    Пауза перед повтором: Retry-After из ответа 429/503 или случайная экспоненциальная
+    (response - ответ requests или aiohttp, нужны только заголовки)
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), API_BACKOFF_MAX)
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF * 2 ** attempt))
+
+
+def _request(endpoint: str, url: str) -> requests.Response:
+    """
+    Выполняет GET через общую сессию с таймаутами endpoint и повторами;
+    каждая попытка проходит выключатель endpoint (breaker.py) и берёт жетон
+    квоты (quota.py) с приоритетом текущего контекста
+
+    Returns:
+        Response: Последний ответ (после повторов может быть 429/5xx)
+
+    Raises:
+        requests.RequestException: Таймаут чтения или соединение не удалось и после повторов
+        QuotaExceeded: Квота API исчерпана для приоритета запроса
+        CircuitOpen: Выключатель endpoint разомкнут - API деградировал
+    """
+    timeout = API_TIMEOUTS.get(endpoint, API_DEFAULT_TIMEOUT)
+    breaker = get_breaker(endpoint)
+    for attempt in range(API_RETRIES + 1):
+        last_attempt = attempt == API_RETRIES
+        breaker.allow()
+        try:
+            quota.acquire()
+        except QuotaExceeded:
+            breaker.release()
+            raise
+        started = time.monotonic()
+        try:
+            response = _session.get(url, timeout=timeout)
+        except requests.ConnectionError:
+            # Сюда входит и таймаут соединения; таймаут чтения не повторяем -
+            # это удвоило бы ожидание пользователя
+            breaker.record(True, time.monotonic() - started)
+            if last_attempt:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        except requests.RequestException:
+            breaker.record(True, time.monotonic() - started)
+            raise
+
+        breaker.record(is_failure_status(response.status_code), time.monotonic() - started)
+        if response.status_code not in API_RETRY_STATUSES or last_attempt:
+            return response
+        time.sleep(backoff_delay(attempt, response))
+        response.close()
+
+
+def _get_json(endpoint: str, url: str, raise_errors: bool = False):
+    """
+    Выполняет запрос к API и возвращает разобранный JSON
+
+    При ошибке печатает код ответа и возвращает None,
+    а с raise_errors=True выбрасывает ApiError с этим кодом
+    (0 - сетевая ошибка или таймаут), QuotaExceeded или CircuitOpen
+    """
+    try:
+        response = _request(endpoint, url)
+    except (QuotaExceeded, CircuitOpen) as e:
+        print(e)
+        if raise_errors:
+            raise
+        return None
+    except requests.RequestException as e:
+        print(f"Ошибка: {e}")
+        if raise_errors:
+            raise ApiError(0, f"Ошибка соединения: {e}")
+        return None
+
+    if response.status_code == 200:
+        return response.json()
+    print(f"Ошибка: {response.status_code}")
+    if raise_errors:
+        raise ApiError(response.status_code)
+    return None
+
+
 def get_current_weather(city: str=None, latitude: float=None, longitude: float=None) -> dict:
     if city:
         print(f"Получаем погоду для города {city}")
@@ -18,40 +156,27 @@ def get_current_weather(city: str=None, latitude: float=None, longitude: float=N
         print(f"Получаем погоду для координат {latitude}, {longitude}")
         return get_weather_by_coordinates(latitude, longitude)
 
-def get_weather_by_coordinates(latitude: float, longitude: float) -> dict:
+def get_weather_by_coordinates(latitude: float, longitude: float, raise_errors: bool = False) -> dict:
     url = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric&lang=ru"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        return print(f"Ошибка: {response.status_code}")
+    return _get_json("weather", url, raise_errors)
 
-def get_coordinates(city: str) -> tuple[float, float]:
-    url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}&limit=1"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()[0]['lat'], response.json()[0]['lon']
-    else:
-        print(f"Ошибка: {response.status_code}")
-        return  None
+def get_coordinates(city: str, raise_errors: bool = False) -> tuple[float, float]:
+    url = f"https://api.openweathermap.org/geo/1.0/direct?q={city}&appid={API_KEY}&limit=1"
+    results = _get_json("geo", url, raise_errors)
+    if not results:
+        # Пустой список - город не найден
+        if results is not None and raise_errors:
+            raise ApiError(404, f"Город не найден: {city}")
+        return None
+    return results[0]['lat'], results[0]['lon']
 
-def get_hourly_weather(latitude: float, longitude: float) -> dict:
+def get_hourly_weather(latitude: float, longitude: float, raise_errors: bool = False) -> dict:
     url = f"https://api.openweathermap.org/data/2.5/forecast?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric&lang=ru"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Ошибка: {response.status_code}")
-        return None
+    return _get_json("forecast", url, raise_errors)
 
-def get_air_pollution(latitude: float, longitude: float) -> dict:
+def get_air_pollution(latitude: float, longitude: float, raise_errors: bool = False) -> dict:
     url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={latitude}&lon={longitude}&appid={API_KEY}&units=metric&lang=ru"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Ошибка: {response.status_code}")
-        return None
+    return _get_json("air_pollution", url, raise_errors)
 
 def analyze_air_pollution(air_pollution: dict) -> dict:
     """
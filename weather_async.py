@@ -0,0 +1,262 @@
+"""
+Асинхронный клиент OpenWeatherMap API (aiohttp) с тем же кэшем, что и weather_cached.py
+
+Повторяет get_weather_by_coordinates, get_hourly_weather, get_air_pollution
+и get_coordinates из weather_cached.py: те же записи кэша, stale-while-revalidate,
+отрицательные записи, квота (quota.py), выключатели (breaker.py), данные
+на случай сбоя API и счётчики stats_snapshot(): шаги запроса через кэш
+и реестр single-flight общие (lookup_cached, begin_api_call, join_flight
+и т.д. из weather_cached.py), отличаются только сам запрос к API
+и ожидание чужого запроса. Нужен там, где запросов
+сразу много (цикл уведомлений, несколько городов): вместо потока на каждый
+запрос - один цикл событий и не больше concurrency запросов к API одновременно.
+
+    async with AsyncWeatherClient() as client:
+        weather, forecast = await asyncio.gather(
+            client.get_weather_by_coordinates(lat, lon),
+            client.get_hourly_weather(lat, lon))
+
+Из синхронного кода (обработчики telebot, поток уведомлений) - через
+fetch_locations или run(). Обращения к кэшу (память или
+SQLite) короткие и выполняются прямо в цикле событий.
+"""
+
+import os
+import time
+import asyncio
+from typing import Optional, Tuple, Dict, Any, List, Callable, Awaitable, Iterable, Sequence, TypeVar
+
+import aiohttp
+
+from weather_app_v2 import (
+    API_KEY, API_TIMEOUTS, API_DEFAULT_TIMEOUT, API_RETRIES, API_RETRY_STATUSES, ApiError, backoff_delay
+)
+from cache import get_cache_key, get_city_key, get_city_query_key
+from weather_cached import (
+    lookup_cached, begin_api_call, store_api_result, record_api_error, with_fallback,
+    lookup_coordinates, begin_geocoding, store_coordinates,
+    join_flight, finish_flight, flight_result
+)
+from quota import quota, QuotaExceeded
+from breaker import get_breaker, is_failure_status, CircuitOpen
+
+T = TypeVar("T")
+
+# Сколько запросов к API один клиент выполняет одновременно
+API_ASYNC_CONCURRENCY = int(os.getenv("API_ASYNC_CONCURRENCY", "10"))
+
+_BASE_URL = "https://api.openweathermap.org"
+
+# Пути endpoint (устаревшие записи обновляются в фоне синхронным
+# клиентом тем же пулом потоков, что и в weather_cached.py)
+_PATHS = {
+    "weather": "/data/2.5/weather",
+    "forecast": "/data/2.5/forecast",
+    "air_pollution": "/data/2.5/air_pollution",
+}
+
+
+class AsyncWeatherClient:
+    """
+    Асинхронный клиент с общим пулом соединений на время блока async with
+
+    Одновременные запросы одной записи кэша объединяются (single-flight) -
+    внутри клиента и с синхронными вызовами weather_cached из других потоков;
+    всего к API одновременно идёт не больше concurrency запросов.
+    """
+
+    def __init__(self, concurrency: int = None):
+        self.concurrency = concurrency or API_ASYNC_CONCURRENCY
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._flights: Dict[str, asyncio.Future] = {}
+
+    async def __aenter__(self) -> "AsyncWeatherClient":
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self._session.close()
+
+    async def _request(self, endpoint: str, path: str, params: Dict[str, Any]) -> Any:
+        """
+        Выполняет GET с таймаутами endpoint и повторами (как weather_app_v2._request)
+
+        Raises:
+            ApiError: Ответ с ошибкой после повторов (0 - сетевая ошибка или таймаут)
+            QuotaExceeded: Квота API исчерпана для приоритета запроса
+            CircuitOpen: Выключатель endpoint разомкнут - API деградировал
+        """
+        connect, read = API_TIMEOUTS.get(endpoint, API_DEFAULT_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        params = dict(params, appid=API_KEY)
+        breaker = get_breaker(endpoint)
+
+        async with self._semaphore:
+            for attempt in range(API_RETRIES + 1):
+                last_attempt = attempt == API_RETRIES
+                breaker.allow()
+                try:
+                    await quota.acquire_async()
+                except (QuotaExceeded, asyncio.CancelledError):
+                    breaker.release()
+                    raise
+                started = time.monotonic()
+                try:
+                    async with self._session.get(_BASE_URL + path, params=params, timeout=timeout) as response:
+                        breaker.record(is_failure_status(response.status), time.monotonic() - started)
+                        if response.status == 200:
+                            return await response.json()
+                        if response.status not in API_RETRY_STATUSES or last_attempt:
+                            raise ApiError(response.status)
+                        delay = backoff_delay(attempt, response)
+                except aiohttp.ClientConnectorError as e:
+                    # Соединение не установилось - повторяем; таймаут чтения и
+                    # прочие ошибки не повторяем, как и синхронный клиент
+                    breaker.record(True, time.monotonic() - started)
+                    if last_attempt:
+                        raise ApiError(0, f"Ошибка соединения: {e}")
+                    delay = backoff_delay(attempt)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    breaker.record(True, time.monotonic() - started)
+                    raise ApiError(0, f"Ошибка соединения: {e}")
+                await asyncio.sleep(delay)
+
+    async def _single_flight(self, key: str, load: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет load() один раз на все одновременные вызовы с тем же ключом
+
+        Корутины клиента ждут одну задачу, а она регистрируется в общем реестре
+        weather_cached: если тот же ключ уже запрашивает другой поток, задача
+        ждёт его результат в пуле потоков цикла событий, не блокируя цикл.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(self._shared_flight(key, load))
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет запрос остальным
+        return await asyncio.shield(flight)
+
+    @staticmethod
+    async def _shared_flight(key: str, load: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет load() через общий с weather_cached реестр запросов"""
+        flight, leader = join_flight(key)
+        if not leader:
+            await asyncio.get_running_loop().run_in_executor(None, flight.done.wait)
+            return flight_result(flight)
+
+        try:
+            flight.result = await load()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            finish_flight(key, flight)
+        return flight.result
+
+    async def _cached_fetch(self, endpoint: str, latitude: float, longitude: float) -> Optional[dict]:
+        """Возвращает данные endpoint из кэша или запрашивает их у API (см. weather_cached._cached_fetch)"""
+        done, data = lookup_cached(endpoint, latitude, longitude)
+        if done:
+            return data
+        cache_key = get_cache_key(latitude, longitude, endpoint)
+
+        async def load() -> Optional[dict]:
+            data = begin_api_call(endpoint, latitude, longitude)
+            if data is not None:
+                return data
+            params = {"lat": latitude, "lon": longitude, "units": "metric", "lang": "ru"}
+            try:
+                data = await self._request(endpoint, _PATHS[endpoint], params)
+            except (QuotaExceeded, CircuitOpen, ApiError) as e:
+                print(e)
+                return record_api_error(endpoint, cache_key, e)
+            return store_api_result(endpoint, latitude, longitude, data)
+
+        data = await self._single_flight(cache_key, load)
+        return with_fallback(endpoint, latitude, longitude, data)
+
+    async def get_weather_by_coordinates(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Текущая погода по координатам с использованием кэша"""
+        return await self._cached_fetch("weather", latitude, longitude)
+
+    async def get_hourly_weather(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Почасовой прогноз по координатам с использованием кэша"""
+        return await self._cached_fetch("forecast", latitude, longitude)
+
+    async def get_air_pollution(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Загрязнение воздуха по координатам с использованием кэша"""
+        return await self._cached_fetch("air_pollution", latitude, longitude)
+
+    async def get_coordinates(self, city: str) -> Optional[Tuple[float, float]]:
+        """Координаты города с использованием кэша (см. weather_cached.get_coordinates)"""
+        done, coords = lookup_coordinates(city)
+        if done:
+            return coords
+        query_key = get_city_query_key(city)
+
+        async def load() -> Optional[Tuple[float, float]]:
+            coords = begin_geocoding(city)
+            if coords is not None:
+                return coords
+            try:
+                results = await self._request("geo", "/geo/1.0/direct", {"q": city, "limit": 1})
+                if not results:
+                    raise ApiError(404, f"Город не найден: {city}")
+            except (QuotaExceeded, CircuitOpen, ApiError) as e:
+                print(e)
+                return record_api_error("geo", query_key, e)
+            return store_coordinates(city, (results[0]["lat"], results[0]["lon"]))
+
+        return await self._single_flight(get_city_key(city), load)
+
+    async def get_endpoints(self, latitude: float, longitude: float,
+                            endpoints: Sequence[str]) -> Dict[str, Optional[dict]]:
+        """Данные нескольких endpoint для одной локации одновременно: {endpoint: data}"""
+        results = await asyncio.gather(
+            *(self._cached_fetch(endpoint, latitude, longitude) for endpoint in endpoints))
+        return dict(zip(endpoints, results))
+
+
+def run(work: Callable[[AsyncWeatherClient], Awaitable[T]], concurrency: int = None) -> T:
+    """
+    Выполняет work(client) в новом цикле событий из синхронного кода
+
+    Не вызывать из работающего цикла событий - там используйте
+    AsyncWeatherClient напрямую.
+    """
+    async def main() -> T:
+        async with AsyncWeatherClient(concurrency) as client:
+            return await work(client)
+
+    return asyncio.run(main())
+
+
+def fetch_locations(locations: Iterable[Tuple[float, float]], endpoints: Sequence[str] = ("weather",),
+                    concurrency: int = None) -> List[Optional[Dict[str, Optional[dict]]]]:
+    """
+    Получает данные endpoint для многих локаций одновременно
+
+    Args:
+        locations: Координаты (latitude, longitude)
+        endpoints: Какие данные нужны: weather, forecast, air_pollution
+        concurrency: Запросов к API одновременно (по умолчанию API_ASYNC_CONCURRENCY)
+
+    Returns:
+        list: Для каждой локации по порядку {endpoint: data или None}
+        или None, если запрос локации завершился исключением (остальные
+        локации пачки при этом не теряются)
+    """
+    locations = list(locations)
+
+    async def work(client: AsyncWeatherClient) -> List[Optional[Dict[str, Optional[dict]]]]:
+        results = await asyncio.gather(
+            *(client.get_endpoints(lat, lon, endpoints) for lat, lon in locations),
+            return_exceptions=True)
+        for (lat, lon), result in zip(locations, results):
+            if isinstance(result, Exception):
+                print(f"Ошибка получения данных для ({lat}, {lon}): {result}")
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    return run(work, concurrency)
@@ -1,17 +1,389 @@
 """
 Модуль-обертка для weather_app_v2.py с поддержкой кэширования
-Все запросы к API кэшируются на 10 минут
+Запросы к API кэшируются со сроком годности своего endpoint (cache.CACHE_TTL)
+
+Устаревшая, но ещё недавняя запись (окно cache.CACHE_STALE_WINDOW) отдаётся
+сразу, а свежие данные запрашиваются в фоне (stale-while-revalidate):
+пользователь не ждёт запроса к API для популярных локаций.
+
+Одновременные промахи по одной записи кэша объединяются (single-flight):
+к API идёт один запрос, остальные потоки ждут его результат.
+
+Ошибки API (неизвестный город, 4xx, 5xx) запоминаются в кэше на короткий
+срок (cache.CACHE_NEGATIVE_TTL): пока он не истёк, запрос к API не повторяется.
+
+Координаты городов кэшируются надолго (cache.CACHE_TTL["geo"]) по
+нормализованному названию: геокодирование - самый частый запрос бота.
+
+Когда API недоступен (выключатель breaker.py разомкнут, ошибки 5xx/429,
+сеть, квота), отдаются последние сохранённые данные из окна
+cache.CACHE_FALLBACK_WINDOW с ключом "_stale_at" - временем их получения,
+чтобы бот показал пометку «данные от ЧЧ:ММ».
+
+get_bundle и get_city_bundles запрашивают несколько видов данных (и несколько
+городов) одновременно: ответ ждёт самый медленный запрос, а не их сумму.
+
+Шаги запроса через кэш (lookup_cached, begin_api_call, ...) и реестр
+single-flight (join_flight) общие с асинхронным клиентом weather_async.py.
 """
 
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+
 from weather_app_v2 import (
     get_weather_by_coordinates as _get_weather_by_coordinates,
     get_coordinates as _get_coordinates,
     get_hourly_weather as _get_hourly_weather,
     get_air_pollution as _get_air_pollution,
-    analyze_air_pollution
+    analyze_air_pollution,
+    ApiError
 )
-from cache import get_cached, set_cached
-from typing import Optional, Tuple
+from quota import quota, api_priority, QuotaExceeded, BACKGROUND
+from breaker import CircuitOpen, is_failure_status, breakers_snapshot
+from cache import (
+    get_entry, get_fallback, set_cached, get_cache_key, get_negative, set_negative,
+    get_city_key, get_city_query_key, get_city_coordinates, set_city_coordinates,
+    stats_snapshot as cache_stats_snapshot
+)
+from typing import Optional, Tuple, Callable, Set, Dict, Any, Iterable, List, Sequence
+
+# Фоновые обновления устаревших записей: не больше CACHE_REFRESH_WORKERS
+# одновременно и не больше одного на запись кэша
+CACHE_REFRESH_WORKERS = 4
+_refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS,
+                                       thread_name_prefix="cache-refresh")
+_refreshing: Set[str] = set()
+_refreshing_lock = threading.Lock()
+
+# Одновременные части get_bundle / get_city_bundles. Отдельный пул: задачи
+# фонового обновления не должны задерживать ответ пользователю.
+BUNDLE_WORKERS = 8
+_bundle_executor = ThreadPoolExecutor(max_workers=BUNDLE_WORKERS, thread_name_prefix="bundle")
+
+# Счётчики обращений к API по endpoint: requests - промахи кэша, дошедшие
+# до запроса, api_calls - реальные запросы (остальные дождались чужого),
+# api_errors - ответы с ошибкой, refreshes / refresh_errors - фоновые
+# обновления устаревших записей, fallbacks - ответы старыми данными при сбое API
+_FETCH_COUNTERS = ("requests", "api_calls", "api_errors", "refreshes", "refresh_errors", "fallbacks")
+_fetch_stats: Dict[str, Dict[str, int]] = {}
+_fetch_stats_lock = threading.Lock()
+
+
+def _count(endpoint: str, name: str) -> None:
+    """Увеличивает счётчик обращений к API endpoint"""
+    with _fetch_stats_lock:
+        counters = _fetch_stats.get(endpoint)
+        if counters is None:
+            counters = _fetch_stats[endpoint] = dict.fromkeys(_FETCH_COUNTERS, 0)
+        counters[name] += 1
+
+
+def stats_snapshot() -> Dict[str, Any]:
+    """
+    Возвращает счётчики кэша и обращений к API без обращения к базе
+
+    Returns:
+        dict: {"cache": cache.stats_snapshot(), "api": {endpoint: {requests,
+        api_calls, api_errors, coalesced, refreshes, refresh_errors, fallbacks}},
+        "quota": quota.quota.snapshot(),
+        "breakers": breaker.breakers_snapshot()}
+    """
+    with _fetch_stats_lock:
+        api = {endpoint: dict(counters) for endpoint, counters in _fetch_stats.items()}
+    for counters in api.values():
+        counters["coalesced"] = counters["requests"] - counters["api_calls"]
+    return {"cache": cache_stats_snapshot(), "api": api, "quota": quota.snapshot(),
+            "breakers": breakers_snapshot()}
+
+
+class Flight:
+    """Запрос к API, который выполняется прямо сейчас"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+_flights: Dict[str, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def join_flight(key: str) -> Tuple[Flight, bool]:
+    """
+    Регистрирует запрос по ключу в общем реестре (single-flight):
+    (запрос, True если вызывающий его выполняет). Выполняющий обязательно
+    вызывает finish_flight, остальные ждут flight.done и берут flight_result.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight()
+        return flight, True
+
+
+def finish_flight(key: str, flight: Flight) -> None:
+    """Снимает выполненный запрос с учёта и будит ожидающих"""
+    with _flights_lock:
+        del _flights[key]
+    flight.done.set()
+
+
+def flight_result(flight: Flight) -> Any:
+    """Результат завершённого запроса (или его исключение)"""
+    if flight.error is not None:
+        raise flight.error
+    return flight.result
+
+
+def _single_flight(key: str, load: Callable[[], Any]) -> Any:
+    """
+    Выполняет load() один раз на все одновременные вызовы с тем же ключом
+
+    Первый поток выполняет запрос, остальные (обработчики telebot, поток
+    уведомлений, фоновое обновление, AsyncWeatherClient) ждут и получают
+    тот же результат или то же исключение.
+    """
+    flight, leader = join_flight(key)
+    if not leader:
+        flight.done.wait()
+        return flight_result(flight)
+
+    try:
+        flight.result = load()
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        finish_flight(key, flight)
+    return flight.result
+
+
+# ============== ШАГИ ЗАПРОСА ЧЕРЕЗ КЭШ ==============
+#
+# Общие для синхронных функций этого модуля и AsyncWeatherClient
+# (weather_async.py): клиенты отличаются только самим запросом к API
+# и тем, как ждут чужой запрос.
+#
+#     done, data = lookup_cached(endpoint, lat, lon)
+#     if not done:
+#         def load():                              # под single-flight по get_cache_key
+#             data = begin_api_call(endpoint, lat, lon)
+#             if data is not None:
+#                 return data
+#             try:
+#                 data = <запрос к API>
+#             except (QuotaExceeded, CircuitOpen, ApiError) as e:
+#                 return record_api_error(endpoint, cache_key, e)
+#             return store_api_result(endpoint, lat, lon, data)
+#         data = with_fallback(endpoint, lat, lon, <load через single-flight>)
+
+def lookup_cached(endpoint: str, latitude: float, longitude: float) -> Tuple[bool, Optional[dict]]:
+    """
+    Ответ без запроса к API, если он возможен
+
+    Свежая запись отдаётся как есть; устаревшая в пределах окна - тоже,
+    но запускает фоновое обновление. Если API недавно ответил на этот запрос
+    ошибкой, запрос не повторяется, а отдаются данные на случай сбоя.
+
+    Returns:
+        tuple: (True, данные или None) - ответ готов;
+        (False, None) - нужен запрос к API (учтён в счётчике requests)
+    """
+    entry = get_entry(latitude, longitude, endpoint)
+    if entry is not None:
+        if entry.stale:
+            _refresh_in_background(endpoint, latitude, longitude)
+        return True, entry.data
+
+    status = get_negative(get_cache_key(latitude, longitude, endpoint), endpoint)
+    if status is not None:
+        return True, _fallback(endpoint, latitude, longitude, status)
+
+    _count(endpoint, "requests")
+    return False, None
+
+
+def begin_api_call(endpoint: str, latitude: float, longitude: float) -> Optional[dict]:
+    """
+    Первый шаг запроса к API под single-flight: предыдущий запрос мог
+    положить свежую запись уже после нашего промаха
+
+    Returns:
+        dict или None: Данные свежей записи; None - запрос к API нужен
+        (учтён в счётчике api_calls)
+    """
+    entry = get_entry(latitude, longitude, endpoint, max_stale=0, counted=False)
+    if entry is not None and not entry.stale:
+        return entry.data
+    _count(endpoint, "api_calls")
+    return None
+
+
+def store_api_result(endpoint: str, latitude: float, longitude: float,
+                     data: Optional[dict]) -> Optional[dict]:
+    """Кладёт ответ API в кэш и возвращает его"""
+    if data:
+        set_cached(latitude, longitude, endpoint, data)
+    return data
+
+
+def record_api_error(endpoint: str, cache_key: str, error: Exception) -> None:
+    """
+    Запоминает ошибку API отрицательной записью для cache_key; запрос,
+    отброшенный квотой или выключателем, до API не дошёл и не запоминается
+
+    Returns:
+        None: Результат неудачного запроса (для return из load)
+    """
+    if isinstance(error, ApiError):
+        _count(endpoint, "api_errors")
+        set_negative(cache_key, endpoint, error.status)
+    return None
+
+
+def with_fallback(endpoint: str, latitude: float, longitude: float, data: Optional[dict]) -> Optional[dict]:
+    """Результат запроса, а если данных нет - последние сохранённые (см. _fallback)"""
+    if data:
+        return data
+    cache_key = get_cache_key(latitude, longitude, endpoint)
+    return _fallback(endpoint, latitude, longitude, get_negative(cache_key, endpoint))
+
+
+def lookup_coordinates(city: str) -> Tuple[bool, Optional[Tuple[float, float]]]:
+    """
+    Координаты города без запроса к API, если это возможно
+
+    Returns:
+        tuple: (True, координаты) - найдены в кэше; (True, None) - недавно
+        API ответил, что такого города нет (или ошибкой); (False, None) -
+        нужен запрос к API (учтён в счётчике requests)
+    """
+    coords = get_city_coordinates(city)
+    if coords is not None:
+        return True, coords
+    if get_negative(get_city_query_key(city), "geo") is not None:
+        return True, None
+    _count("geo", "requests")
+    return False, None
+
+
+def begin_geocoding(city: str) -> Optional[Tuple[float, float]]:
+    """Первый шаг геокодирования под single-flight (см. begin_api_call)"""
+    coords = get_city_coordinates(city, counted=False)
+    if coords is not None:
+        return coords
+    _count("geo", "api_calls")
+    return None
+
+
+def store_coordinates(city: str, coords: Optional[Tuple[float, float]]) -> Optional[Tuple[float, float]]:
+    """Кладёт ответ геокодирования в кэш и возвращает его"""
+    if coords:
+        set_city_coordinates(city, *coords)
+    return coords
+
+
+# Синхронные запросы к API по endpoint (фоновое обновление и сам запрос)
+_FETCHERS: Dict[str, Callable[..., Optional[dict]]] = {
+    "weather": _get_weather_by_coordinates,
+    "forecast": _get_hourly_weather,
+    "air_pollution": _get_air_pollution,
+}
+
+
+def _fetch_and_store(endpoint: str, latitude: float, longitude: float) -> Optional[dict]:
+    """
+    Запрашивает данные у API и кладёт их в кэш (один запрос на запись кэша);
+    ошибку API запоминает отрицательной записью и возвращает None,
+    запрос, отброшенный квотой или выключателем, тоже возвращает None,
+    но не запоминается
+    """
+    cache_key = get_cache_key(latitude, longitude, endpoint)
+    fetch = _FETCHERS[endpoint]
+
+    def load() -> Optional[dict]:
+        data = begin_api_call(endpoint, latitude, longitude)
+        if data is not None:
+            return data
+        try:
+            data = fetch(latitude, longitude, raise_errors=True)
+        except (QuotaExceeded, CircuitOpen, ApiError) as e:
+            return record_api_error(endpoint, cache_key, e)
+        return store_api_result(endpoint, latitude, longitude, data)
+
+    return _single_flight(cache_key, load)
+
+
+def _refresh(endpoint: str, latitude: float, longitude: float, cache_key: str) -> None:
+    """Запрашивает свежие данные для устаревшей записи и кладёт их в кэш"""
+    try:
+        _count(endpoint, "requests")
+        with api_priority(BACKGROUND):
+            _fetch_and_store(endpoint, latitude, longitude)
+    except Exception as e:
+        _count(endpoint, "refresh_errors")
+        print(f"⚠️ Не удалось обновить кэш {cache_key}: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(cache_key)
+
+
+def _refresh_in_background(endpoint: str, latitude: float, longitude: float) -> None:
+    """Запускает фоновое обновление записи, если оно ещё не идёт"""
+    cache_key = get_cache_key(latitude, longitude, endpoint)
+    if get_negative(cache_key, endpoint) is not None:
+        # API недавно ответил ошибкой - не повторяем, пока она не истечёт
+        return
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+    _count(endpoint, "refreshes")
+    _refresh_executor.submit(_refresh, endpoint, latitude, longitude, cache_key)
+
+
+def _cached_fetch(endpoint: str, latitude: float, longitude: float) -> Optional[dict]:
+    """
+    Возвращает данные endpoint из кэша или запрашивает их у API
+
+    Свежая запись отдаётся как есть; устаревшая в пределах окна - тоже,
+    но запускает фоновое обновление; иначе запрос к API и запись в кэш
+    (одновременные промахи по одной записи ждут один запрос). Если API
+    недавно ответил на этот запрос ошибкой, запрос не повторяется.
+    При сбое API отдаются последние сохранённые данные (см. _fallback).
+    """
+    done, data = lookup_cached(endpoint, latitude, longitude)
+    if done:
+        return data
+    # Если в кэше нет, запрашиваем у API
+    data = _fetch_and_store(endpoint, latitude, longitude)
+    return with_fallback(endpoint, latitude, longitude, data)
+
+
+def _fallback(endpoint: str, latitude: float, longitude: float, status: Optional[int]) -> Optional[dict]:
+    """
+    Последние сохранённые данные, когда свежие получить не удалось
+
+    Args:
+        status: Код ошибки API из отрицательной записи; None - запрос отброшен
+                выключателем или квотой. Если API ответил, что данных нет
+                (4xx, кроме 429), старые данные не подставляются.
+
+    Returns:
+        dict или None: Копия данных с ключом "_stale_at" (время получения, timestamp)
+    """
+    if status is not None and not is_failure_status(status):
+        return None
+    entry = get_fallback(latitude, longitude, endpoint)
+    if entry is None:
+        return None
+    _count(endpoint, "fallbacks")
+    return dict(entry.data, _stale_at=entry.cached_at)
 
 
 def get_weather_by_coordinates(latitude: float, longitude: float) -> Optional[dict]:
@@ -25,17 +397,7 @@ def get_weather_by_coordinates(latitude: float, longitude: float) -> Optional[di
     Returns:
         dict: Данные о погоде или None
     """
-    # Пытаемся получить из кэша
-    cached_data = get_cached(latitude, longitude, "weather")
-    if cached_data:
-        return cached_data
-    
-    # Если в кэше нет, запрашиваем у API
-    data = _get_weather_by_coordinates(latitude, longitude)
-    if data:
-        set_cached(latitude, longitude, "weather", data)
-    
-    return data
+    return _cached_fetch("weather", latitude, longitude)
 
 
 def get_hourly_weather(latitude: float, longitude: float) -> Optional[dict]:
@@ -49,17 +411,7 @@ def get_hourly_weather(latitude: float, longitude: float) -> Optional[dict]:
     Returns:
         dict: Данные прогноза или None
     """
-    # Пытаемся получить из кэша
-    cached_data = get_cached(latitude, longitude, "forecast")
-    if cached_data:
-        return cached_data
-    
-    # Если в кэше нет, запрашиваем у API
-    data = _get_hourly_weather(latitude, longitude)
-    if data:
-        set_cached(latitude, longitude, "forecast", data)
-    
-    return data
+    return _cached_fetch("forecast", latitude, longitude)
 
 
 def get_air_pollution(latitude: float, longitude: float) -> Optional[dict]:
@@ -73,30 +425,92 @@ def get_air_pollution(latitude: float, longitude: float) -> Optional[dict]:
     Returns:
         dict: Данные о загрязнении или None
     """
-    # Пытаемся получить из кэша
-    cached_data = get_cached(latitude, longitude, "air_pollution")
-    if cached_data:
-        return cached_data
-    
-    # Если в кэше нет, запрашиваем у API
-    data = _get_air_pollution(latitude, longitude)
-    if data:
-        set_cached(latitude, longitude, "air_pollution", data)
-    
-    return data
+    return _cached_fetch("air_pollution", latitude, longitude)
 
 
 def get_coordinates(city: str) -> Optional[Tuple[float, float]]:
     """
-    Получает координаты города (без кэширования, т.к. используется редко)
+    Получает координаты города с использованием кэша; «город не найден»
+    и ошибки API запоминаются в кэше на короткий срок
     
     Args:
-        city: Название города
+        city: Название города (регистр, «ё» и транслитерация не важны)
         
     Returns:
         tuple: (latitude, longitude) или None
     """
-    return _get_coordinates(city)
+    done, coords = lookup_coordinates(city)
+    if done:
+        return coords
+    query_key = get_city_query_key(city)
+
+    def load() -> Optional[Tuple[float, float]]:
+        coords = begin_geocoding(city)
+        if coords is not None:
+            return coords
+        try:
+            coords = _get_coordinates(city, raise_errors=True)
+        except (QuotaExceeded, CircuitOpen, ApiError) as e:
+            return record_api_error("geo", query_key, e)
+        return store_coordinates(city, coords)
+
+    return _single_flight(get_city_key(city), load)
+
+
+# Части get_bundle: название -> функция (latitude, longitude)
+_BUNDLE_PARTS: Dict[str, Callable[[float, float], Optional[dict]]] = {
+    "weather": get_weather_by_coordinates,
+    "forecast": get_hourly_weather,
+    "air_pollution": get_air_pollution,
+}
+
+
+def _submit(fn: Callable[..., Any], *args: Any) -> Future:
+    """Запускает fn в пуле частей с контекстом вызывающего потока (приоритет квоты)"""
+    return _bundle_executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def get_bundle(latitude: float, longitude: float,
+               parts: Sequence[str] = ("weather",)) -> Dict[str, Optional[dict]]:
+    """
+    Получает несколько видов данных для одной локации одновременно
+
+    Args:
+        latitude: Широта
+        longitude: Долгота
+        parts: Какие данные нужны: weather, forecast, air_pollution
+
+    Returns:
+        dict: {часть: данные или None}
+    """
+    futures = {part: _submit(_BUNDLE_PARTS[part], latitude, longitude) for part in parts}
+    return {part: future.result() for part, future in futures.items()}
+
+
+def get_city_bundles(cities: Iterable[str],
+                     parts: Sequence[str] = ("weather",)) -> List[Optional[Dict[str, Optional[dict]]]]:
+    """
+    Получает данные для нескольких городов одновременно: сначала координаты
+    всех городов, затем все части всех найденных городов
+
+    Args:
+        cities: Названия городов
+        parts: Какие данные нужны: weather, forecast, air_pollution
+
+    Returns:
+        list: Для каждого города по порядку {часть: данные или None}
+        или None если город не найден
+    """
+    coords = [future.result() for future in [_submit(get_coordinates, city) for city in cities]]
+    futures = [
+        {part: _submit(_BUNDLE_PARTS[part], *city_coords) for part in parts}
+        if city_coords else None
+        for city_coords in coords
+    ]
+    return [
+        {part: future.result() for part, future in city_futures.items()} if city_futures else None
+        for city_futures in futures
+    ]
 
 
 def get_current_weather(city: str = None, latitude: float = None, longitude: float = None) -> Optional[dict]:
@@ -131,6 +545,9 @@ __all__ = [
     'get_coordinates',
     'get_hourly_weather',
     'get_air_pollution',
-    'analyze_air_pollution'
+    'analyze_air_pollution',
+    'get_bundle',
+    'get_city_bundles',
+    'stats_snapshot'
 ]
 